@@ -0,0 +1,182 @@
+import argparse
+import statistics
+import sys
+import uuid
+from datetime import datetime
+
+import requests
+from colorama import Fore, Style
+
+from benchmarking import host_info, write_results
+from budget import load_budget
+from config import Config, LLMProfile
+from profiles import llm_profile, save_profile
+from verify_embeddings import load_corpus
+
+RESULTS_DIRECTORY = "benchmarks/results"
+
+# Lower bound of the characters per token of English text with the tokenizers of the supported models
+CHARS_PER_TOKEN = 5
+
+QUESTION = "Using the context, explain how a company should prepare for and respond to a ransomware attack."
+
+
+def build_prompt(texts: list[str], k: int) -> str:
+    """
+    Stuffs chunks into a prompt, as the question answering chain does with the documents it retrieves.
+    The prompt starts with a random marker so that Ollama cannot reuse the prefill of a previous measurement
+    :param texts: The chunks to sample from
+    :param k: The number of chunks to stuff
+    :return: The prompt
+    """
+    context = "\n\n".join(texts[:k])
+    return f"Request {uuid.uuid4()}. You are a cybersecurity assistant.\n\nContext: {context}\n\nQuestion: {QUESTION}"
+
+
+def estimate_tokens(prompt: str) -> int:
+    """
+    Estimates the token count of a prompt without the tokenizer of the model, erring on the low side
+    :param prompt: The prompt
+    :return: The estimated token count
+    """
+    return len(prompt) // CHARS_PER_TOKEN
+
+
+def measure(llm: str, options: dict, prompt: str) -> dict:
+    """
+    Generates an answer with Ollama
+    :return: The prompt token count and the prefill and decode throughputs, as measured by Ollama
+    """
+    response = requests.post(f"{Config.ollama_url}/api/generate", json={
+        "model": llm, "prompt": prompt, "stream": False, "options": options
+    }, timeout=900)
+    response.raise_for_status()
+    data = response.json()
+    return {
+        "prompt_tokens": data["prompt_eval_count"],
+        "prefill_tokens_per_second": data["prompt_eval_count"] / (data["prompt_eval_duration"] / 1e9),
+        "generated_tokens": data["eval_count"],
+        "decode_tokens_per_second": data["eval_count"] / (data["eval_duration"] / 1e9)
+    }
+
+
+def evaluate_candidate(llm: str, num_ctx: int, num_batch: int, texts: list[str], k: int, tokens: int,
+                       runs: int) -> dict:
+    """
+    Measures a candidate setting. The first generation loads the model with the new context window and is discarded
+    :return: The measurements, the estimated time of a request and whether the candidate fits the prompt
+    """
+    options = {**load_budget().ollama_options(), "num_ctx": num_ctx, "num_batch": num_batch,
+               "num_predict": tokens, "temperature": 0}
+    measure(llm, options, build_prompt(texts, k))
+    samples = [measure(llm, options, build_prompt(texts, k)) for _ in range(runs)]
+
+    prompt_tokens = min(sample["prompt_tokens"] for sample in samples)
+    estimated_tokens = estimate_tokens(build_prompt(texts, k))
+    # Ollama truncates the prompts that do not fit, in which case the model answers without part of the documents.
+    # Older versions report the token count after the truncation, which is then below the estimated prompt length
+    fits = estimated_tokens <= prompt_tokens and prompt_tokens + tokens <= num_ctx
+    times = [sample["prompt_tokens"] / sample["prefill_tokens_per_second"]
+             + sample["generated_tokens"] / sample["decode_tokens_per_second"] for sample in samples]
+    return {
+        "num_ctx": num_ctx,
+        "num_batch": num_batch,
+        "fits": fits,
+        "prompt_tokens": prompt_tokens,
+        "estimated_prompt_tokens": estimated_tokens,
+        "prefill_tokens_per_second": statistics.mean(s["prefill_tokens_per_second"] for s in samples),
+        "decode_tokens_per_second": statistics.mean(s["decode_tokens_per_second"] for s in samples),
+        "request_seconds": statistics.mean(times),
+        # Coefficient of variation of the request time
+        "variation": statistics.stdev(times) / statistics.mean(times) if len(times) > 1 else 0.0
+    }
+
+
+def choose(candidates: list[dict], max_variation: float) -> dict | None:
+    """
+    Chooses the fastest candidate that fits the prompt and whose throughput is stable across runs
+    :return: The chosen candidate, None if no candidate is usable
+    """
+    usable = [c for c in candidates if c.get("error") is None and c["fits"] and c["variation"] <= max_variation]
+    if not usable:
+        return None
+    # Among equally fast candidates, the larger context window leaves room for longer histories and documents
+    return min(usable, key=lambda c: (round(c["request_seconds"], 2), -c["num_ctx"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the prefill and decode throughput of a model with "
+                                                 "candidate context windows and batch sizes against the local Ollama "
+                                                 "server, and writes the fastest stable profile. "
+                                                 "Run from the ai directory.")
+    parser.add_argument("--llm", choices=Config.valid_llms, default=Config.valid_llms[0])
+    parser.add_argument("--k", type=int, default=12,
+                        help="The number of documents stuffed in the prompt, the largest k used by the sessions")
+    parser.add_argument("--num-ctx", type=int, nargs="+", default=[4096, 8192, 16384],
+                        help="The context windows to try")
+    parser.add_argument("--num-batch", type=int, nargs="+", default=[128, 256, 512, 1024],
+                        help="The prefill batch sizes to try")
+    parser.add_argument("--tokens", type=int, default=256, help="The tokens generated per measurement")
+    parser.add_argument("--runs", type=int, default=3, help="The measurements per candidate")
+    parser.add_argument("--max-variation", type=float, default=0.15,
+                        help="The maximum coefficient of variation of the request time of a stable candidate")
+    parser.add_argument("--resources", default=Config.resources_path, help="The directory containing the documents")
+    parser.add_argument("--output", default=Config.llm_profiles_path, help="The profiles path")
+    parser.add_argument("--dry-run", action="store_true", help="Measure without writing the profile")
+    args = parser.parse_args()
+
+    texts = load_corpus(args.resources, args.k)
+    if not texts:
+        print(f"{Fore.RED}[-] No document could be read in {args.resources}{Style.RESET_ALL}", file=sys.stderr)
+        sys.exit(1)
+
+    candidates = []
+    for num_ctx in sorted(args.num_ctx):
+        for num_batch in sorted(args.num_batch):
+            try:
+                candidate = evaluate_candidate(args.llm, num_ctx, num_batch, texts, args.k, args.tokens, args.runs)
+            except requests.exceptions.ConnectionError:
+                print(f"{Fore.RED}[-] Could not reach ollama, is the service running?{Style.RESET_ALL}",
+                      file=sys.stderr)
+                sys.exit(1)
+            except requests.exceptions.RequestException as e:
+                # Large batches or windows may not fit in memory
+                candidate = {"num_ctx": num_ctx, "num_batch": num_batch, "error": str(e)}
+                print(f"{Fore.YELLOW}[!] num_ctx {num_ctx}, num_batch {num_batch}: {e}{Style.RESET_ALL}", flush=True)
+                candidates.append(candidate)
+                continue
+
+            candidates.append(candidate)
+            print(f"{Fore.CYAN}[*] num_ctx {num_ctx}, num_batch {num_batch}: "
+                  f"prefill {candidate['prefill_tokens_per_second']:.1f} tokens/s, "
+                  f"decode {candidate['decode_tokens_per_second']:.1f} tokens/s, "
+                  f"{candidate['request_seconds']:.2f} s per request"
+                  f"{'' if candidate['fits'] else ', prompt truncated'}{Style.RESET_ALL}", flush=True)
+
+    chosen = choose(candidates, args.max_variation)
+    path = write_results(RESULTS_DIRECTORY, "autotune", {
+        "benchmark": "autotune",
+        "timestamp": datetime.now().isoformat(),
+        "host": host_info(),
+        "config": {"llm": args.llm, "k": args.k, "tokens": args.tokens, "runs": args.runs,
+                   "max_variation": args.max_variation},
+        "candidates": candidates,
+        "chosen": chosen
+    })
+
+    if chosen is None:
+        print(f"{Fore.RED}[-] No candidate fits the prompt with a stable throughput, "
+              f"try larger context windows. Measurements written to {path}{Style.RESET_ALL}", file=sys.stderr)
+        sys.exit(1)
+
+    profile = LLMProfile.new(num_ctx=chosen["num_ctx"], num_batch=chosen["num_batch"])
+    print(f"{Fore.GREEN}[+] num_ctx {chosen['num_ctx']}, num_batch {chosen['num_batch']} "
+          f"(the configured profile was {llm_profile(args.llm)}){Style.RESET_ALL}")
+    if not args.dry_run:
+        save_profile(args.output, args.llm, profile)
+        print(f"{Fore.GREEN}[+] Profile written to {args.output}, restart the service to apply it{Style.RESET_ALL}")
+    print(f"{Fore.GREEN}[+] Measurements written to {path}{Style.RESET_ALL}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+import argparse
+import json
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock
+from typing import Any
+
+import requests
+import waitress
+from colorama import Fore, Style
+
+from benchmarking import percentiles, host_info, write_results, peak_rss
+from config import Config
+from mongodb import MongoDatabase
+from pipeline import Pipeline
+from web_handler import WebHandler
+
+RESULTS_DIRECTORY = "benchmarks/results"
+DEFAULT_QUERIES = "benchmarks/queries-v1.json"
+
+FILLER_WORDS = ("security", "risk", "the", "controls", "should", "be", "reviewed", "regularly", "and", "incidents",
+                "reported", "to", "the", "relevant", "authority", "using", "a", "documented", "process")
+
+
+class MockOllamaServer:
+    """
+    Minimal stand-in for the Ollama HTTP API. Streams generated words with a configurable time to first token,
+    prefill rate and decoding rate, so that the service can be load-tested independently of model speed.
+    """
+
+    def __init__(self, port: int, ttft: float, tokens_per_second: float, prefill_per_second: float,
+                 answer_tokens: int):
+        """
+        :param port: The port to listen on
+        :param ttft: The base time to first token in seconds
+        :param tokens_per_second: The simulated decoding throughput
+        :param prefill_per_second: The simulated prompt processing throughput, added to the time to first token
+        :param answer_tokens: The number of tokens generated per answer
+        """
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.prefill_per_second = prefill_per_second
+        self.answer_tokens = answer_tokens
+        self.requests = 0
+        self._lock = Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _answer(self, prompt: str) -> list[str]:
+        if "'grade'" in prompt:
+            words = ['{"grade":', " 3,", ' "remark":', ' "'] + \
+                    [f"{word} " for word in FILLER_WORDS[:max(1, self.answer_tokens - 5)]] + ['"}']
+            return words
+        return [f"{FILLER_WORDS[i % len(FILLER_WORDS)]} " for i in range(self.answer_tokens)]
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == "/api/tags":
+                    body = json.dumps({"models": [{"name": name} for name in Config.valid_llms]}).encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                if self.path not in ("/api/chat", "/api/generate"):
+                    self.send_error(404)
+                    return
+
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                with server._lock:
+                    server.requests += 1
+
+                if self.path == "/api/chat":
+                    prompt = "".join(str(message.get("content", "")) for message in payload.get("messages", []))
+                else:
+                    prompt = str(payload.get("prompt", ""))
+
+                prompt_tokens = max(1, len(prompt) // 4)
+                prefill = prompt_tokens / server.prefill_per_second if server.prefill_per_second > 0 else 0.0
+                words = server._answer(prompt)
+                start = time.perf_counter_ns()
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+                time.sleep(server.ttft + prefill)
+                prefill_ns = time.perf_counter_ns() - start
+
+                for word in words:
+                    self._write_line(self._chunk(payload, word, False))
+                    time.sleep(1 / server.tokens_per_second)
+
+                final = self._chunk(payload, "", True)
+                final.update({
+                    "done_reason": "stop",
+                    "total_duration": time.perf_counter_ns() - start,
+                    "load_duration": 0,
+                    "prompt_eval_count": prompt_tokens,
+                    "prompt_eval_duration": prefill_ns,
+                    "eval_count": len(words),
+                    "eval_duration": time.perf_counter_ns() - start - prefill_ns
+                })
+                self._write_line(final)
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _chunk(self, payload: dict[str, Any], text: str, done: bool) -> dict[str, Any]:
+                chunk = {"model": payload.get("model", ""), "created_at": datetime.now(timezone.utc).isoformat(),
+                         "done": done}
+                if self.path == "/api/chat":
+                    chunk["message"] = {"role": "assistant", "content": text}
+                else:
+                    chunk["response"] = text
+                return chunk
+
+            def _write_line(self, data: dict[str, Any]) -> None:
+                line = (json.dumps(data) + "\n").encode()
+                self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+def make_database(mongo_url: str | None) -> MongoDatabase:
+    """
+    Creates the database used by the benchmark: a local MongoDB if a URL is given, an in-memory stand-in otherwise
+    """
+    if mongo_url is not None:
+        Config.mongo_path = mongo_url
+        return MongoDatabase()
+
+    try:
+        import mongomock
+    except ImportError:
+        print(f"{Fore.RED}[-] The in-memory database requires mongomock (pip install mongomock). "
+              f"Use --mongo to benchmark against a local MongoDB instead{Style.RESET_ALL}", file=sys.stderr)
+        raise SystemExit(1)
+
+    return MongoDatabase(mongomock.MongoClient())
+
+
+class LoadDriver:
+    def __init__(self, base_url: str, questions: list[str], retriever: str, llm: str):
+        self.base_url = base_url
+        self.questions = questions
+        self.retriever = retriever
+        self.llm = llm
+        self.samples: dict[str, list[float]] = {}
+        self.statuses: dict[str, dict[int, int]] = {}
+        self._lock = Lock()
+
+    def _call(self, name: str, method: str, path: str, body: dict[str, Any] | None = None) -> requests.Response:
+        start = time.perf_counter()
+        response = requests.request(method, self.base_url + path, json=body, timeout=600)
+        elapsed = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self.samples.setdefault(name, []).append(elapsed)
+            codes = self.statuses.setdefault(name, {})
+            codes[response.status_code] = codes.get(response.status_code, 0) + 1
+        return response
+
+    def create_sessions(self, count: int, session_type: str) -> list[str]:
+        sessions = []
+        for i in range(count):
+            response = self._call("new_session", "POST", "/new_session", {
+                "name": f"load-{session_type}-{i}", "type": session_type, "llm": self.llm,
+                "retriever": self.retriever, "algorithm": "similarity", "k": 4
+            })
+            response.raise_for_status()
+            session_id = response.json()["session_id"]
+            if session_type == "evaluation":
+                self._call("scenario", "POST", "/scenario", {
+                    "scenario": "A small company was hit by ransomware that encrypted its file servers."
+                }).raise_for_status()
+            sessions.append(session_id)
+        return sessions
+
+    def virtual_user(self, user: int, requests_count: int, mix: dict[str, float], chat_sessions: list[str],
+                     evaluation_sessions: list[str]) -> None:
+        rng = random.Random(user)
+        operations = list(mix.keys())
+        weights = list(mix.values())
+
+        for _ in range(requests_count):
+            operation = rng.choices(operations, weights)[0]
+            start = time.perf_counter()
+            if operation == "ask" and chat_sessions:
+                session_id = chat_sessions[user % len(chat_sessions)]
+                self._call("use_session", "POST", f"/session/{session_id}")
+                self._call("ask", "POST", "/ask", {"question": rng.choice(self.questions)})
+            elif operation == "eval" and evaluation_sessions:
+                session_id = evaluation_sessions[user % len(evaluation_sessions)]
+                self._call("use_session", "POST", f"/session/{session_id}")
+                self._call("eval", "POST", "/eval", {
+                    "criterion": "Containment measures", "answer": rng.choice(self.questions)
+                })
+            else:
+                self._call("sessions", "GET", "/sessions")
+            with self._lock:
+                self.samples.setdefault(f"operation:{operation}", []).append((time.perf_counter() - start) * 1000)
+
+
+def stage_breakdown(pipeline: Pipeline) -> dict[str, dict[str, float]]:
+    """
+    Aggregates the per-stage durations of the traces recorded during the run
+    """
+    stages: dict[str, list[float]] = {}
+    for trace in pipeline.tracer.recent():
+        for name, duration in trace.stage_durations().items():
+            stages.setdefault(name, []).append(duration)
+        stages.setdefault(f"total:{trace.kind}", []).append(trace.duration_ms)
+    return {name: percentiles(values) for name, values in stages.items()}
+
+
+def print_summary(endpoints: dict[str, Any], stages: dict[str, Any], throughput: float) -> None:
+    print(f"\n{'endpoint':<24}{'count':>8}{'p50 ms':>12}{'p95 ms':>12}{'p99 ms':>12}{'errors':>8}")
+    for name, data in endpoints.items():
+        latency = data["latency_ms"]
+        print(f"{name:<24}{data['count']:>8}{latency['p50']:>12.1f}{latency['p95']:>12.1f}{latency['p99']:>12.1f}"
+              f"{data['errors']:>8}")
+    print(f"\n{'stage':<24}{'p50 ms':>12}{'p95 ms':>12}{'p99 ms':>12}")
+    for name, latency in stages.items():
+        print(f"{name:<24}{latency['p50']:>12.1f}{latency['p95']:>12.1f}{latency['p99']:>12.1f}")
+    print(f"\n{Fore.GREEN}[+] Throughput: {throughput:.2f} operations/s{Style.RESET_ALL}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-tests the AI service against a simulated Ollama server. "
+                                                 "Run from the ai directory.")
+    parser.add_argument("--users", type=int, default=8, help="Concurrent virtual users")
+    parser.add_argument("--requests", type=int, default=10, help="Operations per virtual user")
+    parser.add_argument("--mix", default="ask=0.6,eval=0.3,sessions=0.1",
+                        help="Operation weights, e.g. ask=0.6,eval=0.3,sessions=0.1")
+    parser.add_argument("--chat-sessions", type=int, default=4)
+    parser.add_argument("--evaluation-sessions", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=4, help="Waitress worker threads")
+    parser.add_argument("--port", type=int, default=7100, help="Port of the service under test")
+    parser.add_argument("--ollama-port", type=int, default=11500, help="Port of the simulated Ollama server")
+    parser.add_argument("--ttft", type=float, default=0.2, help="Simulated time to first token in seconds")
+    parser.add_argument("--tokens-per-second", type=float, default=40.0, help="Simulated decoding throughput")
+    parser.add_argument("--prefill-per-second", type=float, default=2000.0, help="Simulated prompt throughput")
+    parser.add_argument("--answer-tokens", type=int, default=60, help="Tokens generated per answer")
+    parser.add_argument("--mongo", default=None, help="A local MongoDB URL. Defaults to an in-memory stand-in")
+    parser.add_argument("--retriever", default=Config.valid_retrievers[0], choices=Config.valid_retrievers)
+    parser.add_argument("--queries", default=DEFAULT_QUERIES, help="Query set used as questions")
+    parser.add_argument("--output", default=None, help="The JSON results path")
+    args = parser.parse_args()
+
+    mix = {key: float(value) for key, value in (item.split("=") for item in args.mix.split(","))}
+
+    with open(args.queries, encoding="utf-8") as f:
+        questions = [query["query"] for query in json.load(f)["queries"]]
+
+    ollama = MockOllamaServer(args.ollama_port, args.ttft, args.tokens_per_second, args.prefill_per_second,
+                              args.answer_tokens)
+    ollama.start()
+    Config.ollama_url = ollama.url
+    print(f"{Fore.CYAN}[*] Simulated Ollama listening on {ollama.url}{Style.RESET_ALL}")
+
+    # Keep every trace of the run for the per-stage breakdown
+    Config.trace_buffer_size = max(Config.trace_buffer_size, args.users * args.requests * 2)
+    pipeline = Pipeline(mongodb=make_database(args.mongo))
+    handler = WebHandler("ai_service", pipeline)
+    handler.register()
+    server = waitress.create_server(handler.app, host="127.0.0.1", port=args.port, threads=args.threads)
+    Thread(target=server.run, daemon=True).start()
+
+    driver = LoadDriver(f"http://127.0.0.1:{args.port}", questions, args.retriever, Config.valid_llms[0])
+
+    try:
+        chat_sessions = driver.create_sessions(args.chat_sessions, "chat")
+        evaluation_sessions = driver.create_sessions(args.evaluation_sessions, "evaluation")
+        driver.samples.clear()
+        driver.statuses.clear()
+
+        print(f"{Fore.CYAN}[*] Running {args.users} users x {args.requests} operations{Style.RESET_ALL}")
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.users) as executor:
+            futures = [executor.submit(driver.virtual_user, user, args.requests, mix, chat_sessions,
+                                       evaluation_sessions) for user in range(args.users)]
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - start
+    finally:
+        server.close()
+        ollama.stop()
+
+    endpoints = {}
+    for name, samples in driver.samples.items():
+        codes = driver.statuses.get(name, {})
+        endpoints[name] = {
+            "count": len(samples),
+            "errors": sum(count for code, count in codes.items() if code >= 400),
+            "status_codes": {str(code): count for code, count in codes.items()},
+            "latency_ms": percentiles(samples)
+        }
+
+    operations = args.users * args.requests
+    throughput = operations / elapsed if elapsed > 0 else 0.0
+    stages = stage_breakdown(pipeline)
+    print_summary(endpoints, stages, throughput)
+
+    path = write_results(RESULTS_DIRECTORY, "load", {
+        "benchmark": "load",
+        "timestamp": datetime.now().isoformat(),
+        "host": host_info(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "duration_seconds": elapsed,
+        "operations": operations,
+        "throughput_ops": throughput,
+        "ollama_requests": ollama.requests,
+        "peak_rss_bytes": peak_rss(),
+        "endpoints": endpoints,
+        "stages_ms": stages
+    }, args.output)
+
+    print(f"{Fore.GREEN}[+] Results written to {path}{Style.RESET_ALL}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from datetime import datetime
+from typing import Any
+
+from colorama import Fore, Style
+from langchain_core.documents import Document
+
+from benchmarking import percentiles, current_rss, peak_rss, host_info, write_results
+from config import Config
+from models import AlgorithmType, SSTParams, SimilarityParams, MMRParams, RetrievalMode
+from pipeline import Pipeline
+
+DEFAULT_QUERIES = "benchmarks/queries-v1.json"
+RESULTS_DIRECTORY = "benchmarks/results"
+
+
+def default_params(alg: AlgorithmType, k: int | None) -> MMRParams | SSTParams | SimilarityParams:
+    match alg:
+        case AlgorithmType.sst:
+            return SSTParams.new() if k is None else SSTParams.new(k=k)
+        case AlgorithmType.sim:
+            return SimilarityParams.new() if k is None else SimilarityParams.new(k=k)
+        case AlgorithmType.mmr:
+            return MMRParams.new()
+
+
+def load_queries(path: str) -> dict[str, Any]:
+    """
+    Loads a versioned query set. Each query lists the documents (and optionally the 1-based pages) relevant to it
+    :param path: The query set path
+    :return: The query set
+    """
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+
+    if "version" not in data or "queries" not in data:
+        raise ValueError(f"{path} is not a valid query set, expected 'version' and 'queries' keys")
+
+    return data
+
+
+def relevant_units(query: dict[str, Any]) -> set[tuple[str, int | None]]:
+    """
+    Lists the units that count as relevant for a query: (document, page) pairs when pages are labelled,
+    (document, None) otherwise
+    """
+    units = set()
+    for label in query["relevant"]:
+        pages = label.get("pages")
+        if pages:
+            units.update((label["document"], page) for page in pages)
+        else:
+            units.add((label["document"], None))
+    return units
+
+
+def match_unit(document: Document, units: set[tuple[str, int | None]]) -> tuple[str, int | None] | None:
+    """
+    Finds the relevant unit a retrieved chunk belongs to
+    :param document: The retrieved chunk
+    :param units: The relevant units of the query
+    :return: The matched unit, or None if the chunk is not relevant
+    """
+    source = document.metadata["source"].replace("\\", "/")
+    page = document.metadata["page"] + 1
+    for name, labelled_page in units:
+        if source == name or source.endswith("/" + name):
+            if labelled_page is None or labelled_page == page:
+                return name, labelled_page
+    return None
+
+
+def score_quality(queries: list[dict[str, Any]], retrieved: list[list[Document]]) -> dict[str, float]:
+    """
+    Computes the mean recall@k and mean reciprocal rank of the retrieved chunks, k being the number of chunks returned
+    :param queries: The labelled queries
+    :param retrieved: The chunks retrieved for each query, in rank order
+    :return: The quality metrics
+    """
+    recalls = []
+    reciprocal_ranks = []
+    returned = []
+
+    for query, documents in zip(queries, retrieved):
+        units = relevant_units(query)
+        found = set()
+        first_rank = None
+        for rank, document in enumerate(documents, start=1):
+            unit = match_unit(document, units)
+            if unit is not None:
+                found.add(unit)
+                if first_rank is None:
+                    first_rank = rank
+        recalls.append(len(found) / len(units) if units else 0.0)
+        reciprocal_ranks.append(1 / first_rank if first_rank else 0.0)
+        returned.append(len(documents))
+
+    count = max(len(queries), 1)
+    return {
+        "recall_at_k": sum(recalls) / count,
+        "mrr": sum(reciprocal_ranks) / count,
+        "mean_returned": sum(returned) / count
+    }
+
+
+def benchmark_algorithm(vectorstore, alg: AlgorithmType, params, queries: list[dict[str, Any]], repeat: int,
+                        concurrency: int) -> dict[str, Any]:
+    parents = Pipeline.make_parent_store() if Pipeline.retrieval_mode() == RetrievalMode.parents else None
+    retriever = Pipeline.make_retriever(vectorstore, alg, params, parents=parents)
+    texts = [query["query"] for query in queries]
+
+    # Warm-up, so that lazy initialisations do not count towards the latency
+    retriever.invoke(texts[0])
+
+    latencies = []
+    retrieved: list[list[Document]] = []
+    for iteration in range(repeat):
+        for text in texts:
+            start = time.perf_counter()
+            documents = retriever.invoke(text)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if iteration == 0:
+                retrieved.append(documents)
+
+    workload = texts * repeat
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(retriever.invoke, workload))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "algorithm": alg.value,
+        "params": asdict(params),
+        "latency_ms": percentiles(latencies),
+        "throughput": {
+            "concurrency": concurrency,
+            "queries": len(workload),
+            "qps": len(workload) / elapsed if elapsed > 0 else 0.0
+        },
+        "quality": score_quality(queries, retrieved)
+    }
+
+
+def benchmark_retriever(name: str, algorithms: list[AlgorithmType], queries: list[dict[str, Any]], k: int | None,
+                        repeat: int, concurrency: int) -> list[dict[str, Any]]:
+    print(f"{Fore.CYAN}[*] Benchmarking {name}{Style.RESET_ALL}", flush=True)
+
+    rss_before = current_rss()
+    start = time.perf_counter()
+    vectorstore = Pipeline.make_vectorstore(name)
+    load_time = time.perf_counter() - start
+    rss_after = current_rss()
+
+    memory = {
+        "rss_before_load_bytes": rss_before,
+        "rss_after_load_bytes": rss_after,
+        "load_delta_bytes": rss_after - rss_before if rss_before is not None and rss_after is not None else None,
+    }
+
+    results = []
+    for alg in algorithms:
+        print(f"{Fore.CYAN}[*] Running {alg.value}{Style.RESET_ALL}", flush=True)
+        result = benchmark_algorithm(vectorstore, alg, default_params(alg, k), queries, repeat, concurrency)
+        result["retriever"] = name
+        result["load_seconds"] = load_time
+        result["memory"] = {**memory, "peak_rss_bytes": peak_rss()}
+        results.append(result)
+        print(f"{Fore.GREEN}[+] p50 {result['latency_ms']['p50']:.1f} ms, p95 {result['latency_ms']['p95']:.1f} ms, "
+              f"{result['throughput']['qps']:.1f} qps, recall {result['quality']['recall_at_k']:.2f}, "
+              f"MRR {result['quality']['mrr']:.2f}{Style.RESET_ALL}", flush=True)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the retrievers and search algorithms on a labelled "
+                                                 "query set. Run from the ai directory.")
+    parser.add_argument("--queries", default=DEFAULT_QUERIES, help="The labelled query set to use")
+    parser.add_argument("--retriever", action="append", choices=Config.valid_retrievers,
+                        help="A retriever to benchmark (repeatable, defaults to all)")
+    parser.add_argument("--algorithm", action="append", choices=[alg.name for alg in AlgorithmType],
+                        help="An algorithm to benchmark (repeatable, defaults to all)")
+    parser.add_argument("--k", type=int, default=None, help="Overrides k for the similarity algorithms")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of passes over the query set")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent searches for the throughput test")
+    parser.add_argument("--output", default=None, help="The JSON results path")
+    args = parser.parse_args()
+
+    query_set = load_queries(args.queries)
+    queries = query_set["queries"]
+    if not queries:
+        print(f"{Fore.RED}[-] The query set is empty{Style.RESET_ALL}", file=sys.stderr)
+        return
+
+    retrievers = args.retriever or Config.valid_retrievers
+    algorithms = [AlgorithmType[name] for name in args.algorithm] if args.algorithm else list(AlgorithmType)
+
+    results = []
+    for retriever in retrievers:
+        results.extend(benchmark_retriever(retriever, algorithms, queries, args.k, args.repeat, args.concurrency))
+
+    path = write_results(RESULTS_DIRECTORY, "retrieval", {
+        "benchmark": "retrieval",
+        "timestamp": datetime.now().isoformat(),
+        "query_set": {"path": args.queries, "version": query_set["version"], "count": len(queries)},
+        "host": host_info(),
+        "results": results
+    }, args.output)
+
+    print(f"{Fore.GREEN}[+] Results written to {path}{Style.RESET_ALL}")
+
+
+if __name__ == "__main__":
+    main()
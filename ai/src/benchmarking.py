@@ -0,0 +1,246 @@
+import json
+import math
+import os
+import platform
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock
+from typing import Any, Iterator
+from uuid import uuid4
+
+from tracing import Trace, activate
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    """
+    Summarises a list of measurements
+    :param values: The measurements
+    :return: A dictionary containing the mean, p50, p95, p99 and max values
+    """
+    if not values:
+        return {"mean": 0.0, "p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+
+    ordered = sorted(values)
+
+    def rank(q: float) -> float:
+        # Nearest-rank percentile, good enough for the sample sizes we deal with
+        index = max(0, min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1))
+        return ordered[index]
+
+    return {
+        "mean": sum(ordered) / len(ordered),
+        "p50": rank(0.50),
+        "p95": rank(0.95),
+        "p99": rank(0.99),
+        "max": ordered[-1]
+    }
+
+
+def current_rss() -> int | None:
+    """
+    Returns the current resident set size of the process
+    :return: The RSS in bytes, or None if it cannot be determined on this platform
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return peak_rss()
+
+
+def peak_rss() -> int | None:
+    """
+    Returns the peak resident set size of the process
+    :return: The peak RSS in bytes, or None if it cannot be determined on this platform
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is expressed in bytes on macOS and in kilobytes everywhere else
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+def host_info() -> dict[str, Any]:
+    """
+    Describes the machine the benchmark runs on, so that results can be compared across runs
+    :return: The host description
+    """
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count()
+    }
+
+
+def write_results(directory: str, name: str, results: dict[str, Any], path: str | None = None) -> str:
+    """
+    Writes benchmark results as JSON
+    :param directory: The directory to write the results to if no path is given
+    :param name: The benchmark name, used to generate the file name
+    :param results: The results to write
+    :param path: An explicit output path
+    :return: The path of the written file
+    """
+    if path is None:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+    return path
+
+
+class IngestionStats:
+    """
+    Aggregates the per-stage timings of a document ingestion run. Each document is recorded as a trace so that the
+    embedding time measured by TracedEmbeddings can be separated from the vectorstore write time
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.documents = 0
+        self.pages = 0
+        self.chunks = 0
+        self.stages: dict[str, float] = {}
+        self._start = time.perf_counter()
+        self._end: float | None = None
+        self._lock = Lock()
+
+    @contextmanager
+    def document(self, path: str) -> Iterator[Trace]:
+        """
+        Records the ingestion of a single document
+        :param path: The document path
+        """
+        trace = Trace(str(uuid4()), "ingest", self.name, datetime.now().isoformat(), attributes={"path": path})
+        try:
+            with activate(trace):
+                yield trace
+        finally:
+            durations = trace.stage_durations()
+            with self._lock:
+                self.documents += 1
+                self.pages += trace.attributes.get("pages", 0)
+                self.chunks += trace.attributes.get("chunks", 0)
+                for stage, duration in durations.items():
+                    self.stages[stage] = self.stages.get(stage, 0.0) + duration / 1000
+
+    def finish(self) -> None:
+        self._end = time.perf_counter()
+
+    def summary(self) -> dict[str, Any]:
+        """
+        Computes the per-stage throughput. Stage times are summed across worker threads, so per-stage rates
+        describe a single worker while the wall clock rate describes the whole run
+        :return: The summary
+        """
+        wall = (self._end if self._end is not None else time.perf_counter()) - self._start
+        parse = self.stages.get("parse", 0.0)
+        split = self.stages.get("split", 0.0)
+        embed = self.stages.get("embed", 0.0)
+        write = max(self.stages.get("store", 0.0) - embed, 0.0)
+
+        def rate(count: int, seconds: float) -> float:
+            return count / seconds if seconds > 0 else 0.0
+
+        return {
+            "name": self.name,
+            "documents": self.documents,
+            "pages": self.pages,
+            "chunks": self.chunks,
+            "wall_seconds": wall,
+            "stage_seconds": {"parse": parse, "split": split, "embed": embed, "write": write,
+                              "lock_wait": self.stages.get("lock_wait", 0.0)},
+            "pages_per_second": rate(self.pages, parse),
+            "chunks_per_second": rate(self.chunks, split),
+            "embeddings_per_second": rate(self.chunks, embed),
+            "writes_per_second": rate(self.chunks, write),
+            "wall_chunks_per_second": rate(self.chunks, wall),
+            "peak_rss_bytes": peak_rss()
+        }
+
+
+class TaskProfiler:
+    """
+    Profiles tasks running on worker threads, which cProfile and pyinstrument do not follow on their own, by
+    profiling every task separately and merging the results
+    """
+
+    def __init__(self, kind: str):
+        if kind not in ("cprofile", "pyinstrument"):
+            raise ValueError(f"Unknown profiler: {kind}")
+        if kind == "pyinstrument":
+            try:
+                import pyinstrument
+            except ImportError:
+                raise RuntimeError("The pyinstrument profiler requires pyinstrument (pip install pyinstrument)")
+        self.kind = kind
+        self._result = None
+        self._lock = Lock()
+
+    @contextmanager
+    def task(self) -> Iterator[None]:
+        """
+        Profiles the enclosed block and merges it into the report
+        """
+        if self.kind == "cprofile":
+            import cProfile
+            import pstats
+
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                with self._lock:
+                    if self._result is None:
+                        self._result = pstats.Stats(profiler)
+                    else:
+                        self._result.add(profiler)
+        else:
+            from pyinstrument import Profiler
+            from pyinstrument.session import Session
+
+            profiler = Profiler()
+            profiler.start()
+            try:
+                yield
+            finally:
+                session = profiler.stop()
+                with self._lock:
+                    self._result = session if self._result is None else Session.combine(self._result, session)
+
+    def write(self, directory: str) -> str | None:
+        """
+        Writes the merged report: a pstats file for cProfile, an HTML page for pyinstrument
+        :param directory: The directory to write the report to
+        :return: The report path, or None if nothing was profiled
+        """
+        if self._result is None:
+            return None
+
+        os.makedirs(directory, exist_ok=True)
+        timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+
+        if self.kind == "cprofile":
+            path = os.path.join(directory, f"ingest-profile-{timestamp}.prof")
+            self._result.dump_stats(path)
+            self._result.sort_stats("cumulative").print_stats(25)
+        else:
+            from pyinstrument.renderers import HTMLRenderer
+
+            path = os.path.join(directory, f"ingest-profile-{timestamp}.html")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(HTMLRenderer().render(self._result))
+
+        return path
@@ -0,0 +1,110 @@
+import functools
+import json
+import os
+from dataclasses import dataclass, asdict, fields
+
+from colorama import Fore, Style
+
+from config import Config
+
+
+def cpu_count() -> int:
+    """
+    Returns the number of cores the process may run on, which is lower than the machine core count in containers
+    :return: The number of usable cores
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+@dataclass(slots=True)
+class ResourceBudget:
+    # Intra-op threads of the embedding models
+    embedding_threads: int
+    # Documents parsed and split concurrently by the ingestion
+    ingestion_workers: int
+    # Threads Ollama generates with (num_thread), None to let Ollama decide
+    ollama_threads: int | None = None
+    # Layers Ollama offloads to the GPU (num_gpu), None to let Ollama decide. 0 runs the model on CPU only
+    ollama_gpu_layers: int | None = None
+
+    @staticmethod
+    def default(cores: int | None = None, gpu: bool = False) -> "ResourceBudget":
+        """
+        Splits the cores between the embedding models and Ollama when they share the machine
+        :param cores: The number of cores to split. Defaults to the cores usable by the process
+        :param gpu: Whether the embedding models run on a GPU, in which case they only need a few threads
+        :return: The budget
+        """
+        cores = cores if cores is not None else cpu_count()
+        if gpu:
+            embedding_threads = min(2, cores)
+        else:
+            # Generation is the longest stage of a request, so Ollama gets the larger half
+            embedding_threads = max(1, cores // 2 - 1) if cores > 2 else 1
+        ollama_threads = max(1, cores - embedding_threads)
+        # Parsing is mostly pure Python, more workers only contend for the interpreter lock
+        ingestion_workers = max(1, min(4, cores // 4))
+        return ResourceBudget(embedding_threads, ingestion_workers, ollama_threads)
+
+    @staticmethod
+    def from_dict(data: dict) -> "ResourceBudget":
+        names = [field.name for field in fields(ResourceBudget)]
+        return ResourceBudget(**{name: data[name] for name in names if name in data})
+
+    def save(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(asdict(self), f, indent=2)
+
+    def worker_embedding_threads(self) -> int:
+        """
+        Returns the embedding threads of each server process, the workers of the pre-fork mode sharing the budget
+        :return: The thread count
+        """
+        return max(1, self.embedding_threads // max(1, Config.workers))
+
+    def ollama_options(self) -> dict[str, int]:
+        """
+        Returns the options of the Ollama requests enforcing the budget
+        :return: The options to pass to the chat model, without the ones left to Ollama
+        """
+        options = {}
+        if self.ollama_threads is not None:
+            options["num_thread"] = self.ollama_threads
+        if self.ollama_gpu_layers is not None:
+            options["num_gpu"] = self.ollama_gpu_layers
+        return options
+
+
+@functools.cache
+def load_budget() -> ResourceBudget:
+    """
+    Loads the calibrated resource budget, or the default budget if the machine was not calibrated
+    :return: The budget
+    """
+    if os.path.isfile(Config.budget_path):
+        with open(Config.budget_path, encoding="utf-8") as f:
+            budget = ResourceBudget.from_dict(json.load(f))
+        print(f"{Fore.CYAN}[*] Using the resource budget of {Config.budget_path}: {budget}{Style.RESET_ALL}")
+        return budget
+    return ResourceBudget.default()
+
+
+def apply_torch_budget(budget: ResourceBudget) -> None:
+    """
+    Limits the threads used by torch. Must be called before the embedding models run
+    :param budget: The budget to apply
+    """
+    import torch
+
+    threads = budget.worker_embedding_threads()
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(max(1, min(2, threads)))
+    except RuntimeError:
+        # Can only be set once, before any inter-op parallel work
+        pass
@@ -0,0 +1,227 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from datetime import datetime
+from threading import Event, Thread
+
+import requests
+from colorama import Fore, Style
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from benchmarking import host_info, write_results
+from budget import ResourceBudget, cpu_count
+from config import Config
+from embeddings import make_embeddings
+from verify_embeddings import load_corpus
+
+RESULTS_DIRECTORY = "benchmarks/results"
+
+CALIBRATION_PROMPT = "Explain in a few paragraphs how a company should respond to a ransomware attack."
+
+
+def candidate_threads(cores: int) -> list[int]:
+    """
+    Lists the embedding thread counts to try: powers of two and the even split, always leaving a core to Ollama
+    :param cores: The usable cores
+    :return: The thread counts
+    """
+    candidates = {1, max(1, cores // 2)}
+    threads = 2
+    while threads < cores:
+        candidates.add(threads)
+        threads *= 2
+    return sorted(count for count in candidates if count < cores or cores == 1)
+
+
+def embedding_rate(embeddings, texts: list[str], stop: Event, minimum: float = 2.0) -> float:
+    """
+    Embeds batches of texts until stopped, and for at least a minimum duration
+    :return: The number of texts embedded per second
+    """
+    import torch
+
+    count = 0
+    start = time.perf_counter()
+    with torch.inference_mode():
+        while not stop.is_set() or time.perf_counter() - start < minimum:
+            embeddings.embed_documents(texts)
+            count += len(texts)
+    return count / (time.perf_counter() - start)
+
+
+def generation_rate(llm: str, threads: int | None, gpu_layers: int | None, tokens: int) -> float:
+    """
+    Generates an answer with Ollama
+    :return: The number of tokens generated per second, as measured by Ollama
+    """
+    options = {"num_predict": tokens, "temperature": 0}
+    if threads is not None:
+        options["num_thread"] = threads
+    if gpu_layers is not None:
+        options["num_gpu"] = gpu_layers
+
+    response = requests.post(f"{Config.ollama_url}/api/generate", json={
+        "model": llm, "prompt": CALIBRATION_PROMPT, "stream": False, "options": options
+    }, timeout=600)
+    response.raise_for_status()
+    data = response.json()
+    return data["eval_count"] / (data["eval_duration"] / 1e9)
+
+
+def calibrate_split(embeddings, texts: list[str], cores: int, llm: str | None, gpu_layers: int | None,
+                    tokens: int) -> tuple[int, list[dict]]:
+    """
+    Finds the number of threads to give to the embedding models, the other cores being given to Ollama.
+    Both run at the same time, as they do when the service answers a question while another one is being searched
+    :return: A tuple containing the embedding thread count and the measurements
+    """
+    import torch
+
+    measurements = []
+    for threads in candidate_threads(cores):
+        torch.set_num_threads(threads)
+        ollama_threads = max(1, cores - threads)
+        stop = Event()
+        result = {}
+
+        def embed():
+            result["embeddings_per_second"] = embedding_rate(embeddings, texts, stop)
+
+        worker = Thread(target=embed)
+        worker.start()
+        try:
+            if llm is not None:
+                result["tokens_per_second"] = generation_rate(llm, ollama_threads, gpu_layers, tokens)
+        finally:
+            stop.set()
+            worker.join()
+
+        measurement = {"embedding_threads": threads, "ollama_threads": ollama_threads, **result}
+        measurements.append(measurement)
+        print(f"{Fore.CYAN}[*] {threads} embedding threads: {measurement['embeddings_per_second']:.1f} embeddings/s"
+              + (f", {measurement['tokens_per_second']:.1f} tokens/s" if llm is not None else "")
+              + Style.RESET_ALL, flush=True)
+
+    best_embeddings = max(m["embeddings_per_second"] for m in measurements)
+    if llm is None:
+        # Without Ollama, keep the fewest threads that embed nearly as fast as the most
+        chosen = next(m for m in measurements if m["embeddings_per_second"] >= 0.9 * best_embeddings)
+        return chosen["embedding_threads"], measurements
+
+    # Both stages are on the critical path of a request, so favour the split where neither is starved
+    best_tokens = max(m["tokens_per_second"] for m in measurements)
+    for m in measurements:
+        m["score"] = (m["embeddings_per_second"] / best_embeddings * m["tokens_per_second"] / best_tokens) ** 0.5
+    chosen = max(measurements, key=lambda m: m["score"])
+    return chosen["embedding_threads"], measurements
+
+
+def calibrate_ingestion(resources: str, cores: int, documents: int) -> tuple[int, list[dict]]:
+    """
+    Finds the number of documents to parse and split concurrently
+    :return: A tuple containing the worker count and the measurements
+    """
+    from langchain_community.document_loaders import PyPDFLoader
+
+    files = []
+    for root, directories, names in os.walk(resources):
+        directories.sort()
+        files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith(".pdf"))
+    files = files[:documents]
+
+    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=300)
+
+    def process(path: str) -> int:
+        try:
+            pages = PyPDFLoader(path).load()
+        except Exception:
+            return 0
+        splitter.split_documents(pages)
+        return len(pages)
+
+    measurements = []
+    workers = 1
+    while workers <= max(1, cores):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pages = sum(executor.map(process, files))
+        rate = pages / (time.perf_counter() - start)
+        measurements.append({"workers": workers, "pages_per_second": rate})
+        print(f"{Fore.CYAN}[*] {workers} ingestion workers: {rate:.1f} pages/s{Style.RESET_ALL}", flush=True)
+        workers *= 2
+
+    best = max(m["pages_per_second"] for m in measurements)
+    chosen = next(m for m in measurements if m["pages_per_second"] >= 0.95 * best)
+    return chosen["workers"], measurements
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures how to split the cores of this machine between the "
+                                                 "embedding models, the ingestion and Ollama, and writes the "
+                                                 "resource budget. Run from the ai directory.")
+    parser.add_argument("--retriever", choices=Config.valid_retrievers, default=Config.valid_retrievers[2])
+    parser.add_argument("--llm", choices=Config.valid_llms, default=Config.valid_llms[0],
+                        help="The model generating during the calibration")
+    parser.add_argument("--no-ollama", action="store_true",
+                        help="Calibrate the embedding models alone, when Ollama runs on another machine")
+    parser.add_argument("--ollama-gpu-layers", type=int, default=None,
+                        help="The number of layers Ollama offloads to the GPU (num_gpu), 0 to run on CPU only")
+    parser.add_argument("--tokens", type=int, default=128, help="The tokens generated per measurement")
+    parser.add_argument("--documents", type=int, default=16, help="The documents parsed per ingestion measurement")
+    parser.add_argument("--resources", default=Config.resources_path, help="The directory containing the documents")
+    parser.add_argument("--output", default=Config.budget_path, help="The resource budget path")
+    args = parser.parse_args()
+
+    import torch
+
+    cores = cpu_count()
+    gpu = torch.cuda.is_available()
+    llm = None if args.no_ollama else args.llm
+    print(f"{Fore.CYAN}[*] Calibrating {cores} cores{' and a GPU' if gpu else ''}{Style.RESET_ALL}", flush=True)
+
+    texts = load_corpus(args.resources, 16)
+    if not texts:
+        print(f"{Fore.RED}[-] No document could be read in {args.resources}{Style.RESET_ALL}", file=sys.stderr)
+        sys.exit(1)
+
+    budget = ResourceBudget.default(cores, gpu)
+    budget.ollama_gpu_layers = args.ollama_gpu_layers
+    if args.no_ollama:
+        # Ollama runs elsewhere, the embedding models may use every core
+        budget.ollama_threads = None
+
+    split = []
+    if not gpu:
+        embeddings = make_embeddings(args.retriever, Config.retrievers[args.retriever].backend)
+        try:
+            budget.embedding_threads, split = calibrate_split(embeddings, texts, cores, llm, args.ollama_gpu_layers,
+                                                              args.tokens)
+        except requests.exceptions.ConnectionError:
+            print(f"{Fore.RED}[-] Could not reach ollama, is the service running? "
+                  f"Use --no-ollama to calibrate without it{Style.RESET_ALL}", file=sys.stderr)
+            sys.exit(1)
+        if llm is not None:
+            budget.ollama_threads = max(1, cores - budget.embedding_threads)
+
+    budget.ingestion_workers, ingestion = calibrate_ingestion(args.resources, cores, args.documents)
+
+    budget.save(args.output)
+    path = write_results(RESULTS_DIRECTORY, "calibration", {
+        "benchmark": "calibration",
+        "timestamp": datetime.now().isoformat(),
+        "host": host_info(),
+        "config": {"cores": cores, "gpu": gpu, "retriever": args.retriever, "llm": llm},
+        "split": split,
+        "ingestion": ingestion,
+        "budget": asdict(budget)
+    })
+
+    print(f"{Fore.GREEN}[+] {budget}{Style.RESET_ALL}")
+    print(f"{Fore.GREEN}[+] Resource budget written to {args.output}, measurements to {path}{Style.RESET_ALL}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import argparse
+import json
+import os
+import sys
+from dataclasses import dataclass, asdict
+from threading import Lock
+
+from colorama import Fore, Style
+
+from config import Config
+
+# Raw source strings remembered by resolve, a few per document in practice
+MAX_ALIASES = 4096
+
+
+def normalise_path(path: str) -> str:
+    """
+    Normalises a document path to a path relative to the resources directory using forward slashes.
+    Paths stored in the vectorstores may be absolute, relative to the ai directory or use Windows separators
+    :param path: The path to normalise
+    :return: The normalised path
+    """
+    parts = [part for part in path.replace("\\", "/").split("/") if part and part != "."]
+    resources = os.path.basename(os.path.normpath(Config.resources_path))
+
+    if resources in parts:
+        # Use the last occurrence, the resources directory may itself be nested in a directory of the same name
+        parts = parts[len(parts) - parts[::-1].index(resources):]
+
+    return "/".join(parts)
+
+
+def publisher_of(path: str) -> str:
+    """
+    Returns the publisher of a document, which is the name of the directory containing it (ANSSI, ENISA...)
+    :param path: The document path
+    :return: The publisher, or an empty string for documents at the root of the resources directory
+    """
+    parts = normalise_path(path).split("/")
+    return parts[-2] if len(parts) > 1 else ""
+
+
+@dataclass(slots=True)
+class DocumentEntry:
+    doc_id: int
+    path: str
+    pages: int
+    title: str
+    # Global index of the first page of the document, pages of all documents being numbered consecutively
+    page_offset: int
+    size: int
+    publisher: str = ""
+
+
+class Catalogue:
+    def __init__(self, path: str | None = None):
+        """
+        Catalogue constructor. The catalogue maps the documents of the resources directory to compact ids
+        :param path: The JSON file the catalogue is saved to, or None to keep it in memory only
+        """
+        self.path = path
+        self._entries: list[DocumentEntry] = []
+        self._by_path: dict[str, DocumentEntry] = {}
+        # Raw source strings found in chunk metadata -> entry, filled on first successful resolution
+        self._aliases: dict[str, DocumentEntry] = {}
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def load(path: str) -> "Catalogue":
+        """
+        Loads a catalogue, or returns an empty catalogue if the file does not exist
+        :param path: The catalogue path
+        :return: The catalogue
+        """
+        catalogue = Catalogue(path)
+        if os.path.isfile(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            for element in data["documents"]:
+                entry = DocumentEntry(**element)
+                # Catalogues created before publishers were recorded
+                entry.publisher = entry.publisher or publisher_of(entry.path)
+                catalogue._insert(entry)
+        return catalogue
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with self._lock:
+            data = {"documents": [asdict(entry) for entry in self._entries]}
+
+        # Write then rename so that a concurrent reader never sees a partial file
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        os.replace(temporary, self.path)
+
+    def _insert(self, entry: DocumentEntry) -> None:
+        self._entries.append(entry)
+        self._by_path[entry.path] = entry
+
+    def add(self, path: str, pages: int, title: str | None = None) -> DocumentEntry:
+        """
+        Registers a document. Documents already registered keep their id
+        :param path: The document path
+        :param pages: The number of pages of the document
+        :param title: The document title. Defaults to the file name
+        :return: The document entry
+        """
+        normalised = normalise_path(path)
+        full_path = os.path.join(Config.resources_path, normalised)
+        size = os.path.getsize(full_path) if os.path.isfile(full_path) else 0
+        title = title or os.path.splitext(os.path.basename(normalised))[0]
+
+        with self._lock:
+            entry = self._by_path.get(normalised)
+            if entry is not None:
+                if entry.pages != pages:
+                    entry.pages = pages
+                    self._update_offsets(entry.doc_id + 1)
+                entry.title = title
+                entry.size = size
+                entry.publisher = publisher_of(normalised)
+                return entry
+
+            offset = self._entries[-1].page_offset + self._entries[-1].pages if self._entries else 0
+            entry = DocumentEntry(len(self._entries), normalised, pages, title, offset, size, publisher_of(normalised))
+            self._insert(entry)
+            self._aliases.clear()
+            return entry
+
+    def _update_offsets(self, start: int) -> None:
+        for index in range(max(start, 1), len(self._entries)):
+            previous = self._entries[index - 1]
+            self._entries[index].page_offset = previous.page_offset + previous.pages
+
+    def get(self, doc_id: int) -> DocumentEntry | None:
+        return self._entries[doc_id] if 0 <= doc_id < len(self._entries) else None
+
+    def resolve(self, source: str) -> DocumentEntry | None:
+        """
+        Finds the entry of a document from a source path as stored in chunk metadata or returned by the API
+        :param source: The source path
+        :return: The entry, or None if the document is not catalogued
+        """
+        entry = self._aliases.get(source)
+        if entry is None:
+            entry = self._by_path.get(normalise_path(source))
+            # Sources come from requests too: misses are not cached and the aliases are bounded, so that requests
+            # for arbitrary paths cannot grow the map
+            if entry is not None and len(self._aliases) < MAX_ALIASES:
+                self._aliases[source] = entry
+        return entry
+
+    def publishers(self) -> list[str]:
+        with self._lock:
+            return sorted({entry.publisher for entry in self._entries if entry.publisher})
+
+    def entries(self) -> list[DocumentEntry]:
+        with self._lock:
+            return list(self._entries)
+
+    def build(self, directory: str) -> int:
+        """
+        Registers every PDF document of a directory, reading the page count and title of each one
+        :param directory: The directory to scan recursively
+        :return: The number of documents registered
+        """
+        from pypdf import PdfReader
+
+        paths = Catalogue.pdf_paths(directory)
+        for path in paths:
+            try:
+                reader = PdfReader(path)
+                metadata = reader.metadata
+                self.add(path, len(reader.pages), metadata.title if metadata is not None else None)
+            except Exception as e:
+                # Still register the document so that it can be served and scoped, with an unknown page count
+                print(f"{Fore.RED}[-] Failed to read {path}: {e}{Style.RESET_ALL}", file=sys.stderr)
+                self.add(path, 0)
+        return len(paths)
+
+    def reserve(self, paths: list[str]) -> None:
+        """
+        Registers the documents not catalogued yet in the given order, with an unknown page count until they are read
+        :param paths: The document paths
+        """
+        for path in paths:
+            if self.resolve(path) is None:
+                self.add(path, 0)
+
+    @staticmethod
+    def pdf_paths(directory: str) -> list[str]:
+        """
+        Lists the PDF documents of a directory recursively, in the order their ids are given
+        :param directory: The directory to scan
+        :return: The document paths
+        """
+        paths = []
+        for root, directories, files in os.walk(directory):
+            # Walk in a stable order so that ids do not depend on the file system
+            directories.sort()
+            paths.extend(os.path.join(root, file) for file in sorted(files) if file.endswith(".pdf"))
+        return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds the document catalogue from the resources directory. "
+                                                 "Run from the ai directory.")
+    parser.add_argument("--resources", default=Config.resources_path, help="The directory containing the documents")
+    parser.add_argument("--output", default=Config.catalogue_path, help="The catalogue path")
+    args = parser.parse_args()
+
+    catalogue = Catalogue.load(args.output)
+    count = catalogue.build(args.resources)
+    catalogue.save()
+    print(f"{Fore.GREEN}[+] Catalogued {count} documents in {args.output}{Style.RESET_ALL}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,31 +2,115 @@ import os
 from dataclasses import dataclass
 
 
+# Embedding inference backend used by the retrievers that do not set one: torch, int8 or onnx, see embeddings.py
+DEFAULT_EMBEDDING_BACKEND = os.environ.get("EmbeddingBackend", "torch")
+
+
 @dataclass
 class RetrieverConfig:
     llm_name: str
     embeddings_size: int
+    backend: str = DEFAULT_EMBEDDING_BACKEND
+
+    @staticmethod
+    def new(llm_name: str, model_size: int, backend: str = DEFAULT_EMBEDDING_BACKEND):
+        return RetrieverConfig(llm_name, model_size, backend)
+
+
+@dataclass
+class LLMProfile:
+    # Context window in tokens. Must fit the stuffed documents of the largest k, the history and the answer. Every
+    # request to a model should use the same value, as Ollama reloads the model when it changes
+    num_ctx: int | None = None
+    # Prompt tokens processed at once during the prefill
+    num_batch: int | None = None
+    # Maximum tokens generated for an answer, and for an evaluation
+    num_predict: int | None = None
+    eval_num_predict: int | None = None
+    eval_temperature: float | None = None
+    # How long Ollama keeps the model loaded after a request
+    keep_alive: str | None = None
 
     @staticmethod
-    def new(llm_name: str, model_size: int):
-        return RetrieverConfig(llm_name, model_size)
+    def new(num_ctx: int | None = None, num_batch: int | None = None, num_predict: int | None = None,
+            eval_num_predict: int | None = None, eval_temperature: float | None = None,
+            keep_alive: str | None = None):
+        return LLMProfile(num_ctx, num_batch, num_predict, eval_num_predict, eval_temperature, keep_alive)
 
 
 class Config:
     is_docker = True if os.environ.get('DOCKER') else False
     listen_port = 7000
+    # Server processes. Above 1, the models are loaded once and the workers are forked from the loading process,
+    # sharing the active session through MongoDB, see workers.py
+    workers = int(os.environ.get("Workers", "1"))
+    # Seconds the pre-fork workers have to finish their requests when the server stops
+    worker_shutdown_timeout = 10
+    langchain_debug = True if os.environ.get('LangchainDebug') else False
+    trace_log_path = os.environ.get("TraceLog", "logs/traces.jsonl")
+    trace_buffer_size = 256
+    # Moves the database writes of /ask and /eval to a background queue
+    write_behind = True if os.environ.get('WriteBehind') else False
+    write_queue_size = 1024
+    # Returns the stored grade when the same answer is evaluated again with the same scenario, criterion and settings
+    grade_cache = True if os.environ.get('GradeCache') else False
+    # Searches the raw question while the chat history is used to rephrase it. The results are kept when the
+    # rephrased question is at least this similar to the raw one (difflib ratio)
+    speculative_retrieval = True if os.environ.get('SpeculativeRetrieval') else False
+    speculation_threshold = 0.9
+    # Identical questions and evaluations received while the first one is being answered share its answer
+    coalesce_requests = True if os.environ.get('CoalesceRequests') else False
     mongo_path = os.environ.get("DatabaseUrl")
     if mongo_path is None:
         mongo_path = "mongodb://localhost:27017"
+    ollama_url = os.environ.get("OllamaUrl")
+    if ollama_url is None:
+        ollama_url = "http://localhost:11434"
+    resources_path = "resources"
+    catalogue_path = "db/catalogue.json"
+    # Cache lifetime of the documents served by the API, in seconds
+    document_max_age = 86400
+    # On-disk cache of the pages extracted from documents
+    page_cache_path = "cache/pages"
+    page_cache_size = 512 * 1024 * 1024
+    # Directory where the pre-fork workers share their metrics, and the time between two writes of each worker
+    metrics_path = "cache/metrics"
+    metrics_flush_interval = 5
+    max_extracted_pages = 20
+    # chunks searches overlapping 1000 characters chunks. parents searches small non-overlapping chunks and returns
+    # the pages containing them, stored once in the parent store. Each mode has its own index, see vectorize.py
+    retrieval_mode = os.environ.get("RetrievalMode", "chunks")
+    parent_store_path = "db/parents"
+    child_chunk_size = 400
     valid_llms = ["mistral", "phi3", "llama3.1"]
+    # Ollama options of each model, overridden by the profiles written by autotune.py
+    llm_profiles: dict[str, LLMProfile] = {
+        "mistral": LLMProfile.new(num_ctx=8192, num_predict=1024, eval_num_predict=512, eval_temperature=0,
+                                  keep_alive="30m"),
+        "phi3": LLMProfile.new(num_ctx=4096, num_predict=1024, eval_num_predict=512, eval_temperature=0,
+                               keep_alive="30m"),
+        "llama3.1": LLMProfile.new(num_ctx=8192, num_predict=1024, eval_num_predict=512, eval_temperature=0,
+                                   keep_alive="30m")
+    }
+    llm_profiles_path = os.environ.get("LLMProfiles", "db/llm_profiles.json")
     valid_retrievers = ["sentence-transformers/all-MiniLM-L12-v2",
                         "sentence-transformers/all-mpnet-base-v2",
                         "BAAI/bge-m3"]
+    # Retrievers whose embedding model and vectorstore are loaded in the background at startup
+    warm_up_retrievers = [name for name in os.environ.get("WarmUpRetrievers", valid_retrievers[2]).split(",") if name]
     retrievers: dict[str, RetrieverConfig] = {
         "BAAI/bge-m3": RetrieverConfig.new("BAAI/bge-m3", 1024),
         "sentence-transformers/all-mpnet-base-v2": RetrieverConfig.new("sentence-transformers/all-mpnet-base-v2", 768),
         "sentence-transformers/all-MiniLM-L12-v2": RetrieverConfig.new("sentence-transformers/all-MiniLM-L12-v2", 384)
     }
+    # Queries embedded on CPU while other queries are queued wait up to this window to be embedded together with them.
+    # Disabled (0) unless set, as the batcher only pays off under concurrent load
+    embedding_batch_window_ms = float(os.environ.get("EmbeddingBatchWindow", "0"))
+    embedding_batch_size = 32
+    # Maximum number of queries of a /search/batch request
+    max_search_queries = 256
+    # Threads given to the embedding models, the ingestion and Ollama, written by calibrate.py
+    budget_path = os.environ.get("ResourceBudget", "db/budget.json")
     database_stores: dict[int, str] = {
         1024: "db/embed-1024/",
         768: "db/embed-768/",
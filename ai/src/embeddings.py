@@ -0,0 +1,131 @@
+import os
+import time
+from concurrent.futures import Future
+from queue import Empty, Queue
+from threading import Thread
+
+from colorama import Fore, Style
+from langchain_core.embeddings import Embeddings
+
+from budget import apply_torch_budget, load_budget
+from config import Config
+from metrics import REGISTRY
+
+EMBEDDING_BATCH_SIZE = REGISTRY.histogram("datadiver_embedding_batch_size",
+                                          "Queries embedded together by the dynamic batcher", ("retriever",),
+                                          buckets=(1, 2, 4, 8, 16, 32, 64))
+
+BACKENDS = ("torch", "int8", "onnx")
+
+
+class BatchingEmbeddings(Embeddings):
+    """
+    Embeddings wrapper grouping the queries embedded concurrently into batches. Running one batch is much cheaper than
+    running each query on its own on CPU. A query waits at most the batching window for other queries to join it, and
+    does not wait when no other query is queued
+    """
+
+    def __init__(self, embeddings: Embeddings, name: str, max_batch_size: int, window: float):
+        """
+        BatchingEmbeddings constructor
+        :param embeddings: The embeddings to batch
+        :param name: The retriever name, used to label the batch size metric
+        :param max_batch_size: The maximum number of queries embedded at once
+        :param window: The time a query waits for other queries in seconds
+        """
+        self.embeddings = embeddings
+        self.name = name
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self._start()
+        # Threads do not survive a fork, the workers of the pre-fork mode start their own batcher
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._start)
+
+    def _start(self) -> None:
+        self._queue: Queue[tuple[str, Future]] = Queue()
+        self._worker = Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._worker.start()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        # Documents are already embedded in batches by the ingestion
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            # A query alone is embedded right away, the window is only waited when other queries are already queued
+            concurrent = not self._queue.empty()
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter() if concurrent else 0
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except Empty:
+                    break
+
+            EMBEDDING_BATCH_SIZE.observe(len(batch), retriever=self.name)
+            try:
+                vectors = self.embeddings.embed_documents([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+
+def make_embeddings(retriever_name: str, backend: str | None = None) -> Embeddings:
+    """
+    Loads the embedding model of a retriever
+    :param retriever_name: The retriever to load
+    :param backend: The inference backend (torch, int8 or onnx). Defaults to the backend of the retriever configuration.
+    torch runs the float model, on GPU when available. int8 runs the model on CPU with its linear layers dynamically
+    quantised to int8. onnx runs the model exported to ONNX through ONNX Runtime on CPU
+    :return: The embeddings
+    """
+    import torch
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    backend = backend if backend is not None else Config.retrievers[retriever_name].backend
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend: {backend}")
+
+    device = "cuda" if backend == "torch" and torch.cuda.is_available() else "cpu"
+    budget = load_budget()
+    apply_torch_budget(budget)
+    model_kwargs = {'device': device, "trust_remote_code": True}
+    encode_kwargs = {'normalize_embeddings': True, "batch_size": Config.embedding_batch_size}
+
+    if backend == "onnx":
+        try:
+            import onnxruntime
+        except ImportError:
+            raise RuntimeError("The onnx backend requires ONNX Runtime "
+                               "(pip install \"sentence-transformers[onnx]>=3.2\")")
+        # The model is exported to ONNX on first load
+        model_kwargs["backend"] = "onnx"
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = budget.worker_embedding_threads()
+        model_kwargs["model_kwargs"] = {"session_options": options}
+
+    print(f"{Fore.CYAN}[*] Loading {retriever_name} with the {backend} backend on {device}{Style.RESET_ALL}")
+
+    hf = HuggingFaceEmbeddings(
+        model_name=retriever_name,
+        model_kwargs=model_kwargs,
+        encode_kwargs=encode_kwargs
+    )
+
+    if backend == "int8":
+        torch.quantization.quantize_dynamic(hf.client, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    if device == "cpu" and Config.embedding_batch_window_ms > 0:
+        return BatchingEmbeddings(hf, retriever_name, Config.embedding_batch_size,
+                                  Config.embedding_batch_window_ms / 1000)
+    return hf
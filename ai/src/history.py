@@ -0,0 +1,189 @@
+import sys
+from array import array
+from dataclasses import dataclass
+from typing import Sequence
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+
+from models import AIHistoryEntry, HistoryEntry, MemoryParams, MemoryType
+
+PackedSources = tuple[tuple[str, array], ...]
+
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the number of tokens of a message. The models are served by Ollama, whose tokenizers are not available
+    locally, so the usual approximation of 4 characters per token is used, plus the message formatting overhead
+    :param text: The message content
+    :return: The estimated token count
+    """
+    return len(text) // 4 + 4
+
+
+def pack_sources(sources: dict[str, list[int]]) -> PackedSources:
+    """
+    Converts sources to a compact representation: interned document names and arrays of page numbers
+    :param sources: A dictionary of document name -> pages
+    :return: The packed sources
+    """
+    return tuple((sys.intern(name), array("I", pages)) for name, pages in sources.items())
+
+
+def unpack_sources(sources: PackedSources) -> dict[str, list[int]]:
+    return {name: pages.tolist() for name, pages in sources}
+
+
+@dataclass(slots=True)
+class StoredMessage:
+    type: str
+    content: str
+    timestamp: str | None = None
+    llm: str | None = None
+    sources: PackedSources = ()
+
+    def to_message(self) -> BaseMessage:
+        """
+        Converts the message to the LangChain message sent to the model. Metadata is not sent and thus not copied
+        :return: The LangChain message
+        """
+        if self.type == "ai":
+            return AIMessage(self.content)
+        return HumanMessage(self.content)
+
+    def to_entry(self) -> HistoryEntry | AIHistoryEntry:
+        if self.type == "ai":
+            return AIHistoryEntry(self.type, self.content.strip(), self.timestamp, self.llm,
+                                  unpack_sources(self.sources))
+        return HistoryEntry(self.type, self.content.strip(), self.timestamp)
+
+
+class CompactChatHistory(BaseChatMessageHistory):
+    """
+    Chat history storing messages as slotted records with interned metadata strings.
+    LangChain messages are only created when the history is read by a chain
+    """
+
+    def __init__(self):
+        self.records: list[StoredMessage] = []
+        # The summary of records[:end], as a (summary, end) tuple so that it is replaced atomically
+        self.summary: tuple[str, int] = ("", 0)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @property
+    def messages(self) -> list[BaseMessage]:
+        return self.to_messages()
+
+    def to_messages(self, start: int = 0, end: int | None = None) -> list[BaseMessage]:
+        """
+        Converts a range of the history to LangChain messages
+        :param start: The index of the first message to convert
+        :param end: The index after the last message to convert, None to convert until the end of the history
+        :return: The LangChain messages
+        """
+        return [record.to_message() for record in self.records[start:end]]
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        for message in messages:
+            metadata = message.response_metadata
+            llm = metadata.get("llm")
+            self.records.append(StoredMessage(sys.intern(message.type),
+                                              message.content,
+                                              metadata.get("timestamp"),
+                                              sys.intern(llm) if llm is not None else None,
+                                              pack_sources(metadata.get("sources", {}))))
+
+    def add_entry(self, entry: HistoryEntry | AIHistoryEntry) -> None:
+        """
+        Appends a stored history entry
+        :param entry: The entry to append
+        """
+        if isinstance(entry, AIHistoryEntry):
+            self.records.append(StoredMessage(sys.intern(entry.type), entry.content, entry.timestamp,
+                                              sys.intern(entry.llm), pack_sources(entry.sources)))
+        else:
+            self.records.append(StoredMessage(sys.intern(entry.type), entry.content, entry.timestamp))
+
+    def annotate(self, index: int, timestamp: str, llm: str | None = None,
+                 sources: dict[str, list[int]] | None = None) -> None:
+        """
+        Sets the metadata of a message. The timestamp is set last, as it marks the message as complete
+        :param index: The message index
+        :param timestamp: The message timestamp
+        :param llm: The LLM that generated the message
+        :param sources: The sources of the message
+        """
+        record = self.records[index]
+        if llm is not None:
+            record.llm = sys.intern(llm)
+        if sources is not None:
+            record.sources = pack_sources(sources)
+        record.timestamp = timestamp
+
+    def entries(self, start: int = 0, end: int | None = None) -> list[HistoryEntry | AIHistoryEntry]:
+        """
+        Converts a range of the history to serializable entries
+        :param start: The index of the first message to convert
+        :param end: The index after the last message to convert, None to convert until the end of the history
+        :return: The entries
+        """
+        return [record.to_entry() for record in self.records[start:end]]
+
+    def token_window_start(self, budget: int) -> int:
+        """
+        Finds the first message of the longest suffix of the history that fits in a token budget
+        :param budget: The token budget
+        :return: The index of the first message of the suffix
+        """
+        start = len(self.records)
+        used = 0
+        while start > 0:
+            used += estimate_tokens(self.records[start - 1].content)
+            if used > budget:
+                break
+            start -= 1
+
+        # Do not send an answer without its question
+        if start < len(self.records) and self.records[start].type == "ai":
+            start += 1
+        return start
+
+    def clear(self) -> None:
+        self.records = []
+        self.summary = ("", 0)
+
+
+class MemoryView(BaseChatMessageHistory):
+    """
+    The part of a chat history sent to the model according to a memory strategy. New messages are appended to the
+    underlying history, which is always stored in full
+    """
+
+    def __init__(self, history: CompactChatHistory, params: MemoryParams):
+        self.history = history
+        self.params = params
+
+    @property
+    def messages(self) -> list[BaseMessage]:
+        match self.params.strategy:
+            case MemoryType.window:
+                return self.history.to_messages(max(0, len(self.history) - 2 * self.params.size))
+            case MemoryType.tokens:
+                return self.history.to_messages(self.history.token_window_start(self.params.size))
+            case MemoryType.summary:
+                summary, end = self.history.summary
+                # The summary lags behind while it is generated, the turns not summarised yet are still bounded
+                messages = self.history.to_messages(max(end, len(self.history) - 2 * self.params.size))
+                return [SystemMessage(SUMMARY_PREFIX + summary)] + messages if summary else messages
+            case _:
+                return self.history.to_messages()
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self.history.add_messages(messages)
+
+    def clear(self) -> None:
+        self.history.clear()
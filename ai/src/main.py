@@ -1,9 +1,26 @@
-from pipeline import Pipeline
+import time
+
+STARTED = time.perf_counter()
+
+from config import Config
 from web_handler import WebHandler
 
 
+def create_pipeline():
+    # Imported here so that LangChain, torch and the models load in the background while the server already listens
+    from pipeline import Pipeline
+    return Pipeline()
+
+
 def main():
-    WebHandler("ai_service", Pipeline()).run()
+    if Config.workers > 1:
+        from workers import PreforkServer
+        PreforkServer(Config.workers, STARTED).run()
+        return
+
+    handler = WebHandler("ai_service", started=STARTED)
+    handler.start_warm_up(create_pipeline)
+    handler.run()
 
 if __name__ == "__main__":
     main()
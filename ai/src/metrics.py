@@ -0,0 +1,406 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock, Thread
+from typing import Callable, Iterator, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from tracing import Trace
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._lock = Lock()
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if set(labels.keys()) != set(self.labels):
+            raise ValueError(f"{self.name}: Expected labels {self.labels} but got {tuple(labels.keys())} instead")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    @abstractmethod
+    def samples(self) -> list[str]:
+        """
+        Renders the values of the metric
+        :return: The sample lines, in the Prometheus text format
+        """
+
+    @abstractmethod
+    def snapshot(self) -> list[list]:
+        """
+        Exports the values of the metric, to combine the metrics of several processes
+        :return: The [label values, value] pairs of the series, serializable as JSON
+        """
+
+    @abstractmethod
+    def merge(self, values: list[list]) -> None:
+        """
+        Adds exported values to the metric
+        :param values: The values, as returned by snapshot
+        """
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, value: float = 1, **labels) -> None:
+        """
+        Increments the counter
+        :param value: The value to add, must be positive
+        :param labels: The label values of the series to increment
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in values.items()]
+
+    def snapshot(self) -> list[list]:
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def merge(self, values: list[list]) -> None:
+        with self._lock:
+            for key, value in values:
+                self._values[tuple(key)] = self._values.get(tuple(key), 0) + value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+        self._function: Callable[[], float | dict[tuple[str, ...], float]] | None = None
+
+    def set(self, value: float, **labels) -> None:
+        """
+        Sets the gauge value
+        :param value: The new value
+        :param labels: The label values of the series to set
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, value: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value: float = 1, **labels) -> None:
+        self.inc(-value, **labels)
+
+    def set_function(self, function: Callable[[], float | dict[tuple[str, ...], float]]) -> None:
+        """
+        Computes the gauge value when scraped instead of storing it.
+        Labelled gauges must return a dictionary of label values -> value
+        :param function: The function to call on scrape
+        """
+        self._function = function
+
+    def _current(self) -> dict[tuple[str, ...], float]:
+        if self._function is not None:
+            result = self._function()
+            return result if isinstance(result, dict) else {(): result}
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self) -> list[str]:
+        values = self._current()
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in values.items()]
+
+    def snapshot(self) -> list[list]:
+        return [[list(key), value] for key, value in self._current().items()]
+
+    def merge(self, values: list[list]) -> None:
+        # The state measured by a gauge belongs to one process, its series are replaced rather than added
+        with self._lock:
+            for key, value in values:
+                self._values[tuple(key)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        """
+        Records an observation
+        :param value: The observed value
+        :param labels: The label values of the series to record to
+        """
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._series:
+                self._series[key] = ([0] * len(self.buckets), [0.0, 0])
+            counts, totals = self._series[key]
+            counts[bisect_left(self.buckets, value)] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """
+        Observes the duration of the enclosed block in seconds
+        :param labels: The label values of the series to record to
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            series = {key: (list(counts), list(totals)) for key, (counts, totals) in self._series.items()}
+
+        lines = []
+        for key, (counts, totals) in series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(totals[0])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {_format_value(totals[1])}")
+        return lines
+
+    def snapshot(self) -> list[list]:
+        with self._lock:
+            return [[list(key), [list(counts), list(totals)]] for key, (counts, totals) in self._series.items()]
+
+    def merge(self, values: list[list]) -> None:
+        with self._lock:
+            for key, (counts, totals) in values:
+                key = tuple(key)
+                if key not in self._series:
+                    self._series[key] = ([0] * len(self.buckets), [0.0, 0])
+                current_counts, current_totals = self._series[key]
+                for index, count in enumerate(counts):
+                    current_counts[index] += count
+                current_totals[0] += totals[0]
+                current_totals[1] += totals[1]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+        self._lock = Lock()
+        # The shared directory and the name of this worker in the pre-fork mode, None when the process serves alone
+        self._shared: tuple[str, str] | None = None
+
+    def _register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"The metric '{metric.name}' is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        """
+        Renders all registered metrics using the Prometheus text exposition format. In the pre-fork mode, the metrics
+        of all the workers are combined: counters and histograms are summed, gauges get a worker label
+        :return: The metrics page
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        if self._shared is not None:
+            self.flush()
+            metrics = self._combine(metrics, self._read_snapshots())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+    def share(self, directory: str, worker: str, interval: float) -> None:
+        """
+        Shares the metrics of this process with the other workers of the pre-fork mode through a directory, where
+        each worker writes its values periodically. A restarted worker continues from the values of the worker it
+        replaces, so that the combined counters never go backwards
+        :param directory: The shared directory
+        :param worker: The name of the worker, stable across restarts
+        :param interval: The time between two writes in seconds
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._shared = (directory, worker)
+
+        path = self._snapshot_path(worker)
+        if os.path.isfile(path):
+            with open(path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+            with self._lock:
+                metrics = list(self._metrics.values())
+            for metric in metrics:
+                if not isinstance(metric, Gauge) and metric.name in snapshot:
+                    metric.merge(snapshot[metric.name])
+
+        def flush_periodically():
+            while True:
+                time.sleep(interval)
+                self.flush()
+
+        Thread(target=flush_periodically, name="metrics", daemon=True).start()
+
+    @staticmethod
+    def reset_shared(directory: str) -> None:
+        """
+        Removes the values left in a shared directory by a previous run
+        :param directory: The shared directory
+        """
+        if not os.path.isdir(directory):
+            return
+        for name in os.listdir(directory):
+            if name.endswith(".json"):
+                os.remove(os.path.join(directory, name))
+
+    def flush(self) -> None:
+        """
+        Writes the values of this process to the shared directory
+        """
+        if self._shared is None:
+            return
+        with self._lock:
+            metrics = list(self._metrics.values())
+        snapshot = {metric.name: metric.snapshot() for metric in metrics}
+
+        path = self._snapshot_path(self._shared[1])
+        # Write then rename so that the other workers never read a partial file
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(temporary, path)
+
+    def _snapshot_path(self, worker: str) -> str:
+        return os.path.join(self._shared[0], f"{worker}.json")
+
+    def _read_snapshots(self) -> dict[str, dict[str, list[list]]]:
+        snapshots = {}
+        directory = self._shared[0]
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(directory, name), encoding="utf-8") as f:
+                    snapshots[name[:-len(".json")]] = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+        return snapshots
+
+    @staticmethod
+    def _combine(metrics: list[Metric], snapshots: dict[str, dict[str, list[list]]]) -> list[Metric]:
+        combined = []
+        for metric in metrics:
+            if isinstance(metric, Gauge):
+                total = Gauge(metric.name, metric.documentation, metric.labels + ("worker",))
+                for worker, snapshot in snapshots.items():
+                    total.merge([[key + [worker], value] for key, value in snapshot.get(metric.name, [])])
+            else:
+                total = Histogram(metric.name, metric.documentation, metric.labels, metric.buckets[:-1]) \
+                    if isinstance(metric, Histogram) else Counter(metric.name, metric.documentation, metric.labels)
+                for snapshot in snapshots.values():
+                    total.merge(snapshot.get(metric.name, []))
+            combined.append(total)
+        return combined
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter("datadiver_http_requests_total",
+                            "HTTP requests handled, by endpoint, method and status code",
+                            ("endpoint", "method", "status"))
+REQUEST_LATENCY = REGISTRY.histogram("datadiver_http_request_duration_seconds",
+                                     "End-to-end HTTP request latency", ("endpoint", "method"))
+RETRIEVAL_LATENCY = REGISTRY.histogram("datadiver_retrieval_duration_seconds",
+                                       "Document retrieval latency (embedding and vector search)",
+                                       ("retriever", "algorithm"))
+GENERATION_LATENCY = REGISTRY.histogram("datadiver_generation_duration_seconds",
+                                        "LLM answer generation latency", ("llm",))
+MONGO_LATENCY = REGISTRY.histogram("datadiver_mongo_operation_duration_seconds",
+                                   "MongoDB operation latency", ("operation",))
+ACTIVE_SESSIONS = REGISTRY.gauge("datadiver_active_sessions", "Sessions with an in-memory history")
+HISTORY_MESSAGES = REGISTRY.gauge("datadiver_history_messages", "Messages held in the in-memory histories")
+GRADE_CACHE_REQUESTS = REGISTRY.counter("datadiver_grade_cache_requests_total",
+                                       "Evaluations looked up in the grade cache, by result (hit or miss)", ("result",))
+SPECULATIVE_RETRIEVALS = REGISTRY.counter("datadiver_speculative_retrievals_total",
+                                          "Searches of the raw question started during the rephrase, by result "
+                                          "(hit if the results were used, miss if they were discarded)", ("result",))
+EMBEDDING_MODELS = REGISTRY.gauge("datadiver_embedding_models_loaded", "Embedding models currently loaded")
+STARTUP_SECONDS = REGISTRY.gauge("datadiver_startup_seconds",
+                                 "Seconds from process start until the server listened (bind) and was ready (ready)",
+                                 ("phase",))
+
+
+def observe_trace(trace: Trace) -> None:
+    """
+    Feeds the retrieval and generation latency histograms from a finished request trace
+    :param trace: The finished trace
+    """
+    durations = trace.stage_durations()
+    retriever = trace.attributes.get("retriever", "unknown")
+    algorithm = trace.attributes.get("algorithm", "unknown")
+    llm = trace.attributes.get("llm", "unknown")
+
+    # The speculative search is the retrieval of the request when its results were used, and no other search ran
+    search = durations.get("search", durations.get("speculative_search"))
+    if search is not None:
+        RETRIEVAL_LATENCY.observe(search / 1000, retriever=retriever, algorithm=algorithm)
+    if "generate" in durations:
+        GENERATION_LATENCY.observe(durations["generate"] / 1000, llm=llm)
@@ -0,0 +1,107 @@
+import argparse
+import sys
+
+from colorama import Fore, Style
+from dacite import from_dict
+from pymongo.errors import ConnectionFailure
+
+from models import EvaluationData
+from mongodb import MongoDatabase, MESSAGES_COLLECTION, EVALUATION_SESSIONS_COLLECTION, ANSWERS_COLLECTION, \
+    EVALUATIONS_COLLECTION, GRADES_COLLECTION
+
+
+def legacy_history_collections(database: MongoDatabase) -> list[str]:
+    """
+    Lists the per-session history collections of the previous storage layout
+    :param database: The database to inspect
+    :return: The session ids
+    """
+    return [name for name in database.history_database.list_collection_names() if name != MESSAGES_COLLECTION]
+
+
+def legacy_evaluation_collections(database: MongoDatabase) -> list[str]:
+    """
+    Lists the per-session evaluation collections of the previous storage layout
+    :param database: The database to inspect
+    :return: The session ids
+    """
+    current = {EVALUATION_SESSIONS_COLLECTION, ANSWERS_COLLECTION, EVALUATIONS_COLLECTION, GRADES_COLLECTION}
+    return [name for name in database.evaluation_database.list_collection_names() if name not in current]
+
+
+def migrate_histories(database: MongoDatabase, dry_run: bool, force: bool, keep: bool) -> int:
+    migrated = 0
+    for session_id in legacy_history_collections(database):
+        collection = database.history_database[session_id]
+
+        if not force and database.messages.count_documents({"session_id": session_id}, limit=1) > 0:
+            print(f"{Fore.YELLOW}[!] History of {session_id} was already migrated, skipping{Style.RESET_ALL}")
+            continue
+
+        # The legacy collections were written with insert_many, so the natural order is the message order
+        entries = [MongoDatabase._to_history_entry(element) for element in collection.find({}, {"_id": 0})]
+        print(f"{Fore.CYAN}[*] History of {session_id}: {len(entries)} messages{Style.RESET_ALL}")
+
+        if dry_run:
+            continue
+
+        database.write_history(session_id, entries)
+        if not keep:
+            collection.drop()
+        migrated += 1
+
+    return migrated
+
+
+def migrate_evaluations(database: MongoDatabase, dry_run: bool, force: bool, keep: bool) -> int:
+    migrated = 0
+    for session_id in legacy_evaluation_collections(database):
+        collection = database.evaluation_database[session_id]
+
+        if not force and database.evaluation_sessions.count_documents({"_id": session_id}, limit=1) > 0:
+            print(f"{Fore.YELLOW}[!] Evaluations of {session_id} were already migrated, skipping{Style.RESET_ALL}")
+            continue
+
+        document = collection.find_one({}, {"_id": 0})
+        if document is None:
+            print(f"{Fore.YELLOW}[!] Evaluations of {session_id} are empty, skipping{Style.RESET_ALL}")
+            continue
+
+        data = from_dict(data_class=EvaluationData, data=document)
+        print(f"{Fore.CYAN}[*] Evaluations of {session_id}: {len(data.answers)} answers, "
+              f"{sum(len(results) for results in data.results.values())} results{Style.RESET_ALL}")
+
+        if dry_run:
+            continue
+
+        database.write_evaluations(session_id, data)
+        if not keep:
+            collection.drop()
+        migrated += 1
+
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrates the per-session MongoDB collections to the consolidated "
+                                                 "messages, sessions, answers and evaluations collections.")
+    parser.add_argument("--dry-run", action="store_true", help="List what would be migrated without writing")
+    parser.add_argument("--keep", action="store_true", help="Keep the legacy collections after migrating them")
+    parser.add_argument("--force", action="store_true", help="Migrate sessions that were already migrated again")
+    args = parser.parse_args()
+
+    database = MongoDatabase()
+
+    try:
+        database.ensure_indexes()
+        histories = migrate_histories(database, args.dry_run, args.force, args.keep)
+        evaluations = migrate_evaluations(database, args.dry_run, args.force, args.keep)
+    except ConnectionFailure:
+        print(f"{Fore.RED}[-] Failed to connect to MongoDB{Style.RESET_ALL}", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"{Fore.GREEN}[+] Migrated {histories} histories and {evaluations} evaluation sessions{Style.RESET_ALL}")
+
+
+if __name__ == "__main__":
+    main()
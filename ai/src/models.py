@@ -1,5 +1,5 @@
 import hashlib
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
 from enum import Enum
 from typing import Any
@@ -9,7 +9,7 @@ from config import Config
 TIME_FORMAT = "%d/%m/%Y %H:%M"
 
 
-@dataclass
+@dataclass(slots=True)
 class EvaluationResult:
     result_id: str
     criterion: str
@@ -31,7 +31,7 @@ class EvaluationData:
         self._get_result_list(answer).append(result)
 
     def _get_result_list(self, answer: str):
-        key = hashlib.sha256(answer.encode()).hexdigest()
+        key = EvaluationData.answer_key(answer)
         if key in self.answers:
             return self.results[key]
 
@@ -39,19 +39,23 @@ class EvaluationData:
         self.results[key] = []
         return self.results[key]
 
+    @staticmethod
+    def answer_key(answer: str) -> str:
+        return hashlib.sha256(answer.encode()).hexdigest()
+
     @staticmethod
     def empty():
         return EvaluationData("", [], dict(), dict())
 
 
-@dataclass
+@dataclass(slots=True)
 class HistoryEntry:
     type: str
     content: str
     timestamp: datetime
 
 
-@dataclass
+@dataclass(slots=True)
 class AIHistoryEntry:
     type: str
     content: str
@@ -85,6 +89,85 @@ class SessionType(Enum):
         raise ValueError(f"{value} is not a valid SessionType value")
 
 
+class RetrievalMode(Enum):
+    # Overlapping chunks are embedded and sent to the LLM
+    chunks = "chunks"
+    # Small chunks are embedded, the pages containing them are sent to the LLM
+    parents = "parents"
+
+    @staticmethod
+    def from_value(value: str):
+        for member in RetrievalMode:
+            if member.value == value:
+                return member
+        raise ValueError(f"{value} is not a valid RetrievalMode value")
+
+
+class MemoryType(Enum):
+    full = "full"
+    window = "window"
+    tokens = "tokens"
+    summary = "summary"
+
+    @staticmethod
+    def from_value(value: str):
+        for member in MemoryType:
+            if member.value == value:
+                return member
+        raise ValueError(f"{value} is not a valid MemoryType value")
+
+
+# Turns kept for window and summary, estimated tokens for tokens. Unused for full
+DEFAULT_MEMORY_SIZES = {
+    MemoryType.full: 0,
+    MemoryType.window: 6,
+    MemoryType.tokens: 2048,
+    MemoryType.summary: 4
+}
+
+
+@dataclass(slots=True)
+class MemoryParams:
+    strategy: MemoryType
+    size: int
+
+    @staticmethod
+    def new(strategy: MemoryType = MemoryType.full, size: int | None = None):
+        return MemoryParams(strategy, DEFAULT_MEMORY_SIZES[strategy] if size is None else size)
+
+    @staticmethod
+    def from_dict(data: dict[str, Any]):
+        return MemoryParams(MemoryType(data["strategy"]), data["size"])
+
+
+@dataclass(slots=True)
+class RetrievalScope:
+    publishers: list[str] = field(default_factory=list)
+    documents: list[int] = field(default_factory=list)
+
+    def is_empty(self) -> bool:
+        return not self.publishers and not self.documents
+
+    def to_filter(self) -> dict[str, Any] | None:
+        """
+        Converts the scope to a vectorstore metadata filter. Selected publishers and documents are combined
+        :return: The filter, or None if the scope is empty
+        """
+        clauses = []
+        if self.publishers:
+            clauses.append({"publisher": {"$in": list(self.publishers)}})
+        if self.documents:
+            clauses.append({"doc_id": {"$in": list(self.documents)}})
+
+        if not clauses:
+            return None
+        return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+    @staticmethod
+    def from_dict(data: dict[str, Any]):
+        return RetrievalScope(list(data.get("publishers", [])), list(data.get("documents", [])))
+
+
 @dataclass
 class SSTParams:
     k: int
@@ -114,7 +197,7 @@ class MMRParams:
         return MMRParams(fetch_k, lambda_mult)
 
 
-@dataclass
+@dataclass(slots=True)
 class SessionConfig:
     _id: str
     display_name: str
@@ -123,6 +206,8 @@ class SessionConfig:
     retriever_name: str
     algorithm_type: AlgorithmType
     algorithm_params: MMRParams | SSTParams | SimilarityParams
+    memory: MemoryParams = field(default_factory=MemoryParams.new)
+    scope: RetrievalScope = field(default_factory=RetrievalScope)
 
     @staticmethod
     def default(session_id: str, display_name: str, session_type: SessionType):
@@ -146,8 +231,12 @@ class SessionConfig:
         else:
             params = SimilarityParams(**data['algorithm_params'])
 
+        # Sessions created before memory strategies were introduced send the full history
+        memory = MemoryParams.from_dict(data["memory"]) if "memory" in data else MemoryParams.new()
+        scope = RetrievalScope.from_dict(data["scope"]) if "scope" in data else RetrievalScope()
+
         return SessionConfig(data["_id"], data["display_name"], session_type, data['llm_name'], data['retriever_name'],
-                             alg_type, params)
+                             alg_type, params, memory, scope)
 
     @property
     def id(self):
@@ -1,28 +1,83 @@
+import functools
 from dataclasses import asdict
 
 from dacite import from_dict
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, InsertOne, ReturnDocument
+from pymongo.errors import BulkWriteError
 
 from config import Config
-from models import SessionConfig, HistoryEntry, AIHistoryEntry, custom_asdict, EvaluationData
+from metrics import MONGO_LATENCY
+from models import SessionConfig, HistoryEntry, AIHistoryEntry, custom_asdict, EvaluationData, EvaluationResult
 
 DEFAULT_TIMEOUT = 2500
 
+DUPLICATE_KEY_ERROR = 11000
+
+MESSAGES_COLLECTION = "messages"
+SUMMARIES_COLLECTION = "summaries"
+EVALUATION_SESSIONS_COLLECTION = "sessions"
+ANSWERS_COLLECTION = "answers"
+EVALUATIONS_COLLECTION = "evaluations"
+GRADES_COLLECTION = "grades"
+STATE_COLLECTION = "state"
+
+# The document holding the state shared by the workers of the pre-fork mode
+SHARED_STATE_ID = "workers"
+
+
+def timed_operation(function):
+    """
+    Records the duration of a database operation in the MongoDB latency histogram
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with MONGO_LATENCY.time(operation=function.__name__):
+            return function(*args, **kwargs)
+
+    return wrapper
+
 
 class MongoDatabase:
-    def __init__(self):
-        self.client = MongoClient(Config.mongo_path,
-                                  connectTimeoutMS=DEFAULT_TIMEOUT,
-                                  socketTimeoutMS=DEFAULT_TIMEOUT,
-                                  serverSelectionTimeoutMS=DEFAULT_TIMEOUT)
+    def __init__(self, client: MongoClient | None = None):
+        """
+        MongoDatabase constructor
+        :param client: The client to use. Defaults to a client connected to the configured MongoDB path
+        """
+        if client is None:
+            client = MongoClient(Config.mongo_path,
+                                 connectTimeoutMS=DEFAULT_TIMEOUT,
+                                 socketTimeoutMS=DEFAULT_TIMEOUT,
+                                 serverSelectionTimeoutMS=DEFAULT_TIMEOUT)
+        self.client = client
         self.history_database = self.client['history']
         self.evaluation_database = self.client['evaluation']
         self.configuration_database = self.client['config']
+        self.messages = self.history_database[MESSAGES_COLLECTION]
+        self.summaries = self.history_database[SUMMARIES_COLLECTION]
+        self.evaluation_sessions = self.evaluation_database[EVALUATION_SESSIONS_COLLECTION]
+        self.answers = self.evaluation_database[ANSWERS_COLLECTION]
+        self.evaluations = self.evaluation_database[EVALUATIONS_COLLECTION]
+        self.grades = self.evaluation_database[GRADES_COLLECTION]
+        self.state = self.configuration_database[STATE_COLLECTION]
+
+    @timed_operation
+    def ensure_indexes(self):
+        """
+        Creates the indexes used by the session queries. Does nothing for indexes that already exist
+        """
+        self.messages.create_index([("session_id", ASCENDING), ("seq", ASCENDING)], unique=True)
+        self.answers.create_index([("session_id", ASCENDING), ("key", ASCENDING)], unique=True)
+        self.answers.create_index([("session_id", ASCENDING), ("_id", ASCENDING)])
+        self.evaluations.create_index([("session_id", ASCENDING), ("criterion", ASCENDING)])
+        self.evaluations.create_index([("session_id", ASCENDING), ("answer_key", ASCENDING)])
 
+    @timed_operation
     def drop_all(self):
-        self.history_database.drop_collection()
-        self.configuration_database.drop_collection()
+        self.client.drop_database(self.history_database.name)
+        self.client.drop_database(self.evaluation_database.name)
+        self.client.drop_database(self.configuration_database.name)
 
+    @timed_operation
     def write_session_config(self, configuration: SessionConfig):
         if configuration.llm_name not in Config.valid_llms:
             raise ValueError(f"Invalid LLM: {configuration.llm_name}")
@@ -32,6 +87,7 @@ class MongoDatabase:
         collection.replace_one({"_id": configuration.id}, asdict(configuration, dict_factory=custom_asdict),
                                upsert=True)
 
+    @timed_operation
     def get_session_config(self, session_id: str) -> SessionConfig | None:
         collection = self.configuration_database["config"]
         result = collection.find_one({"_id": session_id})
@@ -41,55 +97,277 @@ class MongoDatabase:
 
         return SessionConfig.from_dict(result)
 
+    @timed_operation
     def delete_session_config(self, session_id: str):
         collection = self.configuration_database["config"]
         collection.delete_one({"_id": session_id})
 
+    @timed_operation
     def write_history(self, session_id: str, history: list[HistoryEntry | AIHistoryEntry]):
-        collection = self.history_database[session_id]
-        collection.drop()
-        for entry in history:
-            collection.insert_one(asdict(entry, dict_factory=custom_asdict))
+        """
+        Replaces the whole history of a session, dropping its summary
+        """
+        self.messages.delete_many({"session_id": session_id})
+        self.summaries.delete_one({"_id": session_id})
+        self.append_history(session_id, history, 0)
+
+    @timed_operation
+    def append_history(self, session_id: str, entries: list[HistoryEntry | AIHistoryEntry], start_seq: int) -> int:
+        """
+        Appends messages to the history of a session in a single bulk write
+        :param session_id: The session the messages belong to
+        :param entries: The messages to append
+        :param start_seq: The sequence number of the first message, which is its index in the session history
+        :return: The number of messages appended, fewer than given if another process used one of their sequence
+        numbers first, in which case the messages after it were not written
+        """
+        if not entries:
+            return 0
+
+        operations = [InsertOne({"session_id": session_id, "seq": start_seq + i,
+                                 **asdict(entry, dict_factory=custom_asdict)})
+                      for i, entry in enumerate(entries)]
+        try:
+            self.messages.bulk_write(operations, ordered=True)
+        except BulkWriteError as e:
+            if e.details.get("writeConcernErrors") or \
+                    any(error["code"] != DUPLICATE_KEY_ERROR for error in e.details["writeErrors"]):
+                raise
+            return e.details["nInserted"]
+        return len(entries)
 
+    @timed_operation
     def write_evaluations(self, session_id: str, data: EvaluationData):
-        collection = self.evaluation_database[session_id]
-        collection.drop()
-        collection.insert_one(asdict(data, dict_factory=custom_asdict))
+        self.delete_evaluations(session_id)
+        self.evaluation_sessions.insert_one({"_id": session_id, "scenario": data.scenario, "criteria": data.criteria})
 
+        if data.answers:
+            self.answers.insert_many([{"session_id": session_id, "key": key, "answer": answer}
+                                      for key, answer in data.answers.items()])
+
+        results = [{"session_id": session_id, "answer_key": key, **asdict(result, dict_factory=custom_asdict)}
+                   for key, answer_results in data.results.items() for result in answer_results]
+        if results:
+            self.evaluations.insert_many(results)
+
+    @timed_operation
     def delete_history(self, session_id: str):
-        collection = self.history_database[session_id]
-        collection.drop()
+        self.messages.delete_many({"session_id": session_id})
+        self.summaries.delete_one({"_id": session_id})
+
+    @timed_operation
+    def write_summary(self, session_id: str, summary: str, end: int):
+        """
+        Saves the rolling summary of a session history
+        :param session_id: The session
+        :param summary: The summary
+        :param end: The number of messages of the history the summary covers
+        """
+        self.summaries.replace_one({"_id": session_id}, {"summary": summary, "end": end}, upsert=True)
+
+    @timed_operation
+    def delete_summary(self, session_id: str):
+        self.summaries.delete_one({"_id": session_id})
+
+    @timed_operation
+    def get_summary(self, session_id: str) -> tuple[str, int] | None:
+        """
+        Retrieves the rolling summary of a session history
+        :param session_id: The session
+        :return: The summary and the number of messages it covers, None if the history was never summarised
+        """
+        element = self.summaries.find_one({"_id": session_id})
+        return (element["summary"], element["end"]) if element is not None else None
 
+    @timed_operation
+    def get_summaries(self) -> dict[str, tuple[str, int]]:
+        """
+        Retrieves the rolling summaries of all sessions
+        :return: A dictionary of session id -> (summary, number of messages covered)
+        """
+        return {element["_id"]: (element["summary"], element["end"]) for element in self.summaries.find()}
+
+    @timed_operation
+    def delete_evaluations(self, session_id: str):
+        self.evaluation_sessions.delete_one({"_id": session_id})
+        self.answers.delete_many({"session_id": session_id})
+        self.evaluations.delete_many({"session_id": session_id})
+
+    @staticmethod
+    def _to_history_entry(element: dict) -> HistoryEntry | AIHistoryEntry:
+        if element["type"] == "ai":
+            return AIHistoryEntry(element["type"],
+                                  element["content"],
+                                  element["timestamp"],
+                                  element["llm"],
+                                  element["sources"])
+        return HistoryEntry(element["type"],
+                            element["content"],
+                            element["timestamp"])
+
+    @timed_operation
     def get_history(self, session_id: str) -> list[HistoryEntry | AIHistoryEntry]:
-        collection = self.history_database[session_id]
-        elements = collection.find()
-        lst: list[HistoryEntry | AIHistoryEntry] = []
+        elements = self.messages.find({"session_id": session_id}, {"_id": 0, "session_id": 0, "seq": 0}).sort("seq")
+        return [MongoDatabase._to_history_entry(element) for element in elements]
 
+    @timed_operation
+    def get_histories(self) -> dict[str, list[HistoryEntry | AIHistoryEntry]]:
+        """
+        Retrieves the histories of all sessions using a single query
+        :return: A dictionary of session id -> history
+        """
+        histories: dict[str, list[HistoryEntry | AIHistoryEntry]] = {}
+        elements = self.messages.find({}, {"_id": 0, "seq": 0}).sort([("session_id", ASCENDING), ("seq", ASCENDING)])
         for element in elements:
-            if element["type"] == "ai":
-                lst.append(AIHistoryEntry(element["type"],
-                                          element["content"],
-                                          element["timestamp"],
-                                          element["llm"],
-                                          element["sources"]))
-            else:
-                lst.append(HistoryEntry(element["type"],
-                                        element["content"],
-                                        element["timestamp"]))
-
-        return lst
-
-    def get_evaluation_data(self, session_id: str) -> EvaluationData:
-        collection = self.evaluation_database[session_id]
-        element = collection.find_one()
-
-        if element is None:
+            session_id = element.pop("session_id")
+            histories.setdefault(session_id, []).append(MongoDatabase._to_history_entry(element))
+        return histories
+
+    @timed_operation
+    def get_evaluation_data(self, session_id: str, offset: int = 0, limit: int | None = None) -> EvaluationData:
+        """
+        Retrieves the evaluation data of a session. Answers are returned in the order they were first graded
+        :param session_id: The session to retrieve
+        :param offset: The number of answers to skip
+        :param limit: The maximum number of answers to return, or None to return all answers.
+        Use 0 to only retrieve the scenario and criteria
+        :return: The evaluation data
+        """
+        session = self.evaluation_sessions.find_one({"_id": session_id})
+
+        if session is None:
             return EvaluationData.empty()
 
-        return from_dict(data_class=EvaluationData, data=element)
+        if limit == 0:
+            return EvaluationData(session["scenario"], session["criteria"], dict(), dict())
+
+        cursor = self.answers.find({"session_id": session_id}, {"_id": 0, "key": 1, "answer": 1})
+        cursor = cursor.sort("_id").skip(offset)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+
+        answers = {element["key"]: element["answer"] for element in cursor}
+        results: dict[str, list[EvaluationResult]] = {key: [] for key in answers}
+
+        if answers:
+            elements = self.evaluations.find({"session_id": session_id, "answer_key": {"$in": list(answers.keys())}},
+                                             {"_id": 0, "session_id": 0}).sort("_id")
+            for element in elements:
+                key = element.pop("answer_key")
+                results[key].append(from_dict(data_class=EvaluationResult, data=element))
+
+        return EvaluationData(session["scenario"], session["criteria"], answers, results)
+
+    @timed_operation
+    def count_answers(self, session_id: str) -> int:
+        return self.answers.count_documents({"session_id": session_id})
+
+    @timed_operation
+    def set_scenario(self, session_id: str, scenario: str):
+        self.evaluation_sessions.update_one({"_id": session_id},
+                                            {"$set": {"scenario": scenario}, "$setOnInsert": {"criteria": []}},
+                                            upsert=True)
+
+    @timed_operation
+    def set_criteria(self, session_id: str, criteria: list[str]):
+        self.evaluation_sessions.update_one({"_id": session_id},
+                                            {"$set": {"criteria": criteria}, "$setOnInsert": {"scenario": ""}},
+                                            upsert=True)
+
+    @timed_operation
+    def add_criterion(self, session_id: str, criterion: str):
+        self.evaluation_sessions.update_one({"_id": session_id},
+                                            {"$addToSet": {"criteria": criterion}, "$setOnInsert": {"scenario": ""}},
+                                            upsert=True)
 
+    @timed_operation
+    def add_evaluation_result(self, session_id: str, answer: str, result: EvaluationResult):
+        """
+        Appends a single evaluation result to a session. The answer text is only stored the first time it is graded
+        :param session_id: The session the result belongs to
+        :param answer: The graded answer
+        :param result: The evaluation result
+        """
+        key = EvaluationData.answer_key(answer)
+        self.answers.update_one({"session_id": session_id, "key": key},
+                                {"$setOnInsert": {"answer": answer}},
+                                upsert=True)
+        self.evaluations.insert_one({"session_id": session_id, "answer_key": key,
+                                     **asdict(result, dict_factory=custom_asdict)})
+
+    @timed_operation
+    def get_cached_grade(self, key: str) -> EvaluationResult | None:
+        """
+        Retrieves a memoised evaluation result
+        :param key: The grade key, identifying the scenario, criterion, answer and configuration
+        :return: The result, or None if the tuple was never graded
+        """
+        element = self.grades.find_one({"_id": key}, {"_id": 0})
+        return from_dict(data_class=EvaluationResult, data=element) if element is not None else None
+
+    @timed_operation
+    def cache_grade(self, key: str, result: EvaluationResult):
+        """
+        Memoises an evaluation result. Grades are shared by all the sessions
+        :param key: The grade key, identifying the scenario, criterion, answer and configuration
+        :param result: The result
+        """
+        self.grades.replace_one({"_id": key}, asdict(result, dict_factory=custom_asdict), upsert=True)
+
+    @timed_operation
     def get_sessions(self) -> list[str]:
         ids = []
         for doc in self.configuration_database["config"].find({}, {'_id': 1}):
             ids.append(doc['_id'])
         return ids
+
+    @timed_operation
+    def get_shared_state(self) -> dict:
+        """
+        Retrieves the state shared by the workers of the pre-fork mode
+        :return: The state revision, the active session id (None if no session is active) and the number of
+        messages of each session history
+        """
+        state = self.state.find_one({"_id": SHARED_STATE_ID}) or {}
+        return {"revision": state.get("revision", 0), "active": state.get("active"),
+                "histories": state.get("histories", {})}
+
+    def _update_shared_state(self, update: dict) -> int:
+        update["$inc"] = {"revision": 1}
+        state = self.state.find_one_and_update({"_id": SHARED_STATE_ID}, update, upsert=True,
+                                               return_document=ReturnDocument.AFTER)
+        return state["revision"]
+
+    @timed_operation
+    def set_active_session(self, session_id: str | None) -> int:
+        """
+        Changes the session used by all the workers
+        :param session_id: The session to use, None to unload the active session
+        :return: The new state revision
+        """
+        return self._update_shared_state({"$set": {"active": session_id}})
+
+    @timed_operation
+    def set_history_length(self, session_id: str, length: int) -> int:
+        """
+        Records the number of messages of a session history, so that the other workers reload it
+        :param session_id: The session
+        :param length: The number of persisted messages, 0 once the session is deleted
+        :return: The new state revision
+        """
+        return self._update_shared_state({"$set": {f"histories.{session_id}": length}})
+
+    @timed_operation
+    def touch_shared_state(self) -> int:
+        """
+        Records a change of the active session configuration or evaluation data, so that the other workers reload it
+        :return: The new state revision
+        """
+        return self._update_shared_state({})
+
+    @timed_operation
+    def reset_shared_state(self):
+        """
+        Clears the shared state, no session being active when the server starts
+        """
+        self.state.delete_one({"_id": SHARED_STATE_ID})
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import threading
+
+from metrics import REGISTRY
+
+PAGE_CACHE_REQUESTS = REGISTRY.counter("datadiver_page_cache_requests_total",
+                                       "Page extraction requests, by result (hit or miss)", ("result",))
+PAGE_CACHE_BYTES = REGISTRY.gauge("datadiver_page_cache_bytes", "Size of the extracted pages cache")
+
+
+def parse_pages(value: str, max_pages: int, page_count: int | None = None) -> list[int]:
+    """
+    Parses a page selection such as "3", "3,4" or "3-5,9"
+    :param value: The page selection, using 1-based page numbers
+    :param max_pages: The maximum number of pages that can be selected
+    :param page_count: The number of pages of the document, ranges ending past it stop at its last page
+    :return: The sorted unique pages
+    :raises ValueError if the selection is invalid or selects too many pages
+    """
+    pages = set()
+    for part in value.split(","):
+        part = part.strip()
+        try:
+            if "-" in part:
+                first, last = (int(page) for page in part.split("-", 1))
+            else:
+                first = last = int(part)
+        except ValueError:
+            raise ValueError(f"Invalid page selection: '{value}'")
+
+        if first < 1 or first > last:
+            raise ValueError(f"Invalid page selection: '{value}'")
+        if page_count is not None:
+            last = min(last, page_count)
+            if first > last:
+                raise ValueError(f"The document only has {page_count} pages")
+
+        # Checked before expanding the range, which could otherwise hold billions of pages
+        if len(pages) + (last - first + 1) > max_pages:
+            raise ValueError(f"At most {max_pages} pages can be requested at once")
+        pages.update(range(first, last + 1))
+
+    if not pages:
+        raise ValueError(f"Invalid page selection: '{value}'")
+
+    return sorted(pages)
+
+
+class PageCache:
+    def __init__(self, directory: str, max_bytes: int):
+        """
+        PageCache constructor. Extracted pages are stored on disk and evicted in least recently used order
+        :param directory: The cache directory
+        :param max_bytes: The maximum size of the cache
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # The size found by the last scan of the directory. The directory itself is the index of the cache, as the
+        # workers of the pre-fork mode share it: the recency order is kept in the modification times of the files
+        self._size = 0
+
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self._evict()
+
+        PAGE_CACHE_BYTES.set_function(lambda: self._size)
+
+    @staticmethod
+    def key(path: str, pages: list[int], kind: str) -> str:
+        """
+        Computes the cache key of an extraction, which is also used as its ETag.
+        The key changes whenever the source document is modified
+        :param path: The source document path
+        :param pages: The extracted pages
+        :param kind: The extraction kind (pdf or text)
+        :return: The key
+        """
+        stat = os.stat(path)
+        identity = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}|{','.join(map(str, pages))}|{kind}"
+        return hashlib.sha256(identity.encode()).hexdigest()
+
+    def get(self, path: str, pages: list[int], kind: str) -> tuple[str, str]:
+        """
+        Returns the cached extraction of pages of a PDF document, extracting them on a miss
+        :param path: The source document path
+        :param pages: The 1-based pages to extract
+        :param kind: pdf to extract the pages as a PDF document, text to extract their text as JSON
+        :return: A tuple containing the path of the cached file and its ETag
+        :raises ValueError if a page does not exist
+        """
+        key = PageCache.key(path, pages, kind)
+        name = f"{key}.{'pdf' if kind == 'pdf' else 'json'}"
+        file = os.path.join(self.directory, name)
+
+        try:
+            # Hits refresh the modification time, which orders the eviction
+            os.utime(file)
+            PAGE_CACHE_REQUESTS.inc(result="hit")
+            return file, key
+        except FileNotFoundError:
+            pass
+
+        PAGE_CACHE_REQUESTS.inc(result="miss")
+
+        temporary = f"{file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            if kind == "pdf":
+                PageCache._extract_pdf(path, pages, temporary)
+            else:
+                PageCache._extract_text(path, pages, temporary)
+            os.replace(temporary, file)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+        with self._lock:
+            self._evict(name)
+
+        return file, key
+
+    def _evict(self, keep: str | None = None) -> None:
+        """
+        Removes the least recently used files until the cache fits its maximum size. The sizes are read from the
+        directory rather than tracked, as the other workers of the pre-fork mode add and remove files too
+        :param keep: A file never removed, the one just extracted, even if it is larger than the cache on its own
+        """
+        files = []
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.name, stat.st_size))
+            except FileNotFoundError:
+                # Removed by another worker during the scan
+                continue
+
+        files.sort()
+        self._size = sum(size for _, _, size in files)
+        for _, name, size in files:
+            if self._size <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+    @staticmethod
+    def _check_pages(path: str, reader, pages: list[int]) -> None:
+        if pages[-1] > len(reader.pages):
+            raise ValueError(f"{os.path.basename(path)} only has {len(reader.pages)} pages")
+
+    @staticmethod
+    def _extract_pdf(path: str, pages: list[int], output: str) -> None:
+        from pypdf import PdfReader, PdfWriter
+
+        reader = PdfReader(path)
+        PageCache._check_pages(path, reader, pages)
+        writer = PdfWriter()
+        for page in pages:
+            writer.add_page(reader.pages[page - 1])
+        with open(output, "wb") as f:
+            writer.write(f)
+
+    @staticmethod
+    def _extract_text(path: str, pages: list[int], output: str) -> None:
+        from pypdf import PdfReader
+
+        reader = PdfReader(path)
+        PageCache._check_pages(path, reader, pages)
+        data = {"pages": [{"page": page, "text": reader.pages[page - 1].extract_text()} for page in pages]}
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
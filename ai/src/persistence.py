@@ -0,0 +1,149 @@
+import atexit
+import sys
+import time
+import traceback
+from collections import OrderedDict
+from threading import Condition, Thread
+from typing import Callable, Hashable
+
+from colorama import Fore, Style
+
+from metrics import REGISTRY
+
+WRITE_QUEUE_DEPTH = REGISTRY.gauge("datadiver_write_queue_depth", "Database writes waiting in the write-behind queue")
+WRITE_LAG = REGISTRY.gauge("datadiver_write_lag_seconds",
+                           "Age of the oldest database write waiting in the write-behind queue")
+WRITE_COMMIT_LAG = REGISTRY.histogram("datadiver_write_commit_lag_seconds",
+                                      "Delay between queueing a database write and committing it")
+WRITE_COALESCED = REGISTRY.counter("datadiver_write_coalesced_total",
+                                   "Queued database writes replaced by a newer write for the same key")
+WRITE_BLOCKED = REGISTRY.counter("datadiver_write_blocked_total",
+                                 "Database writes that waited for the write-behind queue to have room")
+WRITE_FAILURES = REGISTRY.counter("datadiver_write_failures_total",
+                                  "Database writes dropped after exhausting their retries")
+
+
+class WriteBehindQueue:
+    def __init__(self, max_size: int, retries: int = 3, retry_delay: float = 0.5):
+        """
+        WriteBehindQueue constructor. Writes are executed in order by a background worker. Writes queued with
+        the same key are coalesced: only the most recent one runs, at the position of the first one.
+        The pending writes are flushed when the interpreter exits
+        :param max_size: The maximum number of pending writes. Submitting to a full queue blocks the caller
+        :param retries: The number of times a failed write is retried before being dropped
+        :param retry_delay: The delay between retries in seconds, doubled after each failure
+        """
+        self.max_size = max_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._pending: OrderedDict[Hashable, tuple[Callable[[], None], float]] = OrderedDict()
+        self._running = 0
+        self._closed = False
+        self._condition = Condition()
+        self._worker = Thread(target=self._run, name="write-behind", daemon=True)
+        self._worker.start()
+
+        WRITE_QUEUE_DEPTH.set_function(self.depth)
+        WRITE_LAG.set_function(self.lag)
+        atexit.register(self.close)
+
+    def depth(self) -> int:
+        with self._condition:
+            return len(self._pending)
+
+    def lag(self) -> float:
+        """
+        Returns the age of the oldest pending write
+        :return: The age in seconds, 0 if no write is pending
+        """
+        with self._condition:
+            if not self._pending:
+                return 0.0
+            return time.perf_counter() - min(queued for _, queued in self._pending.values())
+
+    def submit(self, operation: Callable[[], None], key: Hashable | None = None) -> None:
+        """
+        Queues a write
+        :param operation: The function performing the write
+        :param key: The coalescing key, or None if the write must not be coalesced
+        """
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The write-behind queue is closed")
+
+            if key is not None and key in self._pending:
+                # Keep the position and age of the first write so that coalescing never delays it
+                self._pending[key] = (operation, self._pending[key][1])
+                WRITE_COALESCED.inc()
+                return
+
+            if len(self._pending) >= self.max_size:
+                WRITE_BLOCKED.inc()
+                self._condition.wait_for(lambda: len(self._pending) < self.max_size or self._closed)
+
+            self._pending[key if key is not None else object()] = (operation, time.perf_counter())
+            self._condition.notify_all()
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """
+        Waits until every write queued so far is committed
+        :param timeout: The maximum time to wait in seconds, or None to wait indefinitely
+        :return: True if the queue was drained, False on timeout
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending and self._running == 0, timeout)
+
+    def close(self, timeout: float | None = 30) -> None:
+        """
+        Stops accepting writes and waits for the pending writes to be committed
+        :param timeout: The maximum time to wait in seconds
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            pending = len(self._pending)
+            self._condition.notify_all()
+
+        if pending:
+            print(f"{Fore.CYAN}[*] Flushing {pending} pending database writes{Style.RESET_ALL}", flush=True)
+
+        self._worker.join(timeout)
+
+        if self._worker.is_alive():
+            print(f"{Fore.RED}[-] Timed out flushing {self.depth()} database writes{Style.RESET_ALL}",
+                  file=sys.stderr)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._closed)
+                if not self._pending:
+                    return
+                _, (operation, queued) = self._pending.popitem(last=False)
+                self._running += 1
+                self._condition.notify_all()
+
+            try:
+                self._execute(operation)
+                WRITE_COMMIT_LAG.observe(time.perf_counter() - queued)
+            finally:
+                with self._condition:
+                    self._running -= 1
+                    self._condition.notify_all()
+
+    def _execute(self, operation: Callable[[], None]) -> None:
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                operation()
+                return
+            except Exception:
+                if attempt == self.retries:
+                    traceback.print_exc(file=sys.stderr)
+                    print(f"{Fore.RED}[-] Dropped a database write after {self.retries} retries{Style.RESET_ALL}",
+                          file=sys.stderr)
+                    WRITE_FAILURES.inc()
+                    return
+                time.sleep(delay)
+                delay *= 2
@@ -0,0 +1,75 @@
+import functools
+import json
+import os
+from dataclasses import asdict, fields, replace
+
+from colorama import Fore, Style
+
+from config import Config, LLMProfile
+
+
+def profile_from_dict(data: dict) -> LLMProfile:
+    names = [field.name for field in fields(LLMProfile)]
+    return LLMProfile(**{name: data[name] for name in names if name in data})
+
+
+def read_profiles(path: str) -> dict[str, LLMProfile]:
+    """
+    Reads the tuned profiles
+    :param path: The profiles path
+    :return: The profiles by model name, empty if the file does not exist
+    """
+    if not os.path.isfile(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return {name: profile_from_dict(data) for name, data in json.load(f).items()}
+
+
+def save_profile(path: str, llm_name: str, profile: LLMProfile) -> None:
+    """
+    Writes the tuned profile of a model, keeping the profiles of the other models
+    :param path: The profiles path
+    :param llm_name: The tuned model
+    :param profile: The profile to write
+    """
+    profiles = read_profiles(path)
+    profiles[llm_name] = profile
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({name: asdict(value) for name, value in profiles.items()}, f, indent=2)
+
+
+@functools.cache
+def llm_profile(llm_name: str) -> LLMProfile:
+    """
+    Returns the profile of a model: the configured profile, with the settings written by autotune.py applied over it
+    :param llm_name: The model
+    :return: The profile
+    """
+    profile = Config.llm_profiles.get(llm_name, LLMProfile())
+    tuned = read_profiles(Config.llm_profiles_path).get(llm_name)
+    if tuned is not None:
+        overrides = {name: value for name, value in asdict(tuned).items() if value is not None}
+        profile = replace(profile, **overrides)
+        print(f"{Fore.CYAN}[*] Using the tuned profile of {llm_name}: {profile}{Style.RESET_ALL}")
+    return profile
+
+
+def ollama_options(profile: LLMProfile, evaluation: bool = False) -> dict:
+    """
+    Returns the options of the Ollama requests of a model, without the ones left to Ollama
+    :param profile: The profile of the model
+    :param evaluation: Whether the requests grade answers, which use their own prediction cap and temperature
+    :return: The options
+    """
+    options = {
+        "num_ctx": profile.num_ctx,
+        "num_batch": profile.num_batch,
+        "num_predict": profile.eval_num_predict if evaluation else profile.num_predict,
+        "temperature": profile.eval_temperature if evaluation else None,
+        "keep_alive": profile.keep_alive
+    }
+    return {name: value for name, value in options.items() if value is not None}
@@ -95,6 +95,24 @@ def unsupported_media(message: str, additional: dict[str, Any] = None) -> tuple[
     return jsonify(response), 415
 
 
+def service_unavailable(message: str, additional: dict[str, Any] = None) -> tuple[Response, int]:
+    """
+    Creates a new service unavailable response.
+    :param message: The error message.
+    :param additional: Additional response data.
+    :return: A tuple containing the response and status code.
+    """
+    if additional is None:
+        additional = {}
+
+    response = {
+        "name": "Service Unavailable",
+        "message": message,
+        **additional
+    }
+    return jsonify(response), 503
+
+
 def ok(message: str, additional: dict[str, Any] = None) -> tuple[Response, int]:
     """
     Creates a new ok response.
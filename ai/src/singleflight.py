@@ -0,0 +1,56 @@
+from concurrent.futures import Future
+from threading import Lock
+from typing import Callable, Hashable, TypeVar
+
+from metrics import REGISTRY
+
+T = TypeVar("T")
+
+COALESCED_REQUESTS = REGISTRY.counter("datadiver_coalesced_requests_total",
+                                      "Requests served by the computation of an identical request already in flight",
+                                      ("kind",))
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent computations: while a computation is in flight, callers with the same key wait for
+    it and receive its result (or exception) instead of running it again. Completed results are not cached
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls: dict[Hashable, Future] = {}
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+    def do(self, key: Hashable, function: Callable[[], T], kind: str = "unknown") -> tuple[T, bool]:
+        """
+        Runs a computation, or waits for the identical computation in flight
+        :param key: The key identifying the computation inputs
+        :param function: The computation
+        :param kind: The kind of computation, used to label the coalesced requests metric
+        :return: A tuple containing the result and whether it was shared from another caller's computation
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = Future()
+                self._calls[key] = call
+
+        if not leader:
+            COALESCED_REQUESTS.inc(kind=kind)
+            return call.result(), True
+
+        try:
+            result = function()
+            call.set_result(result)
+            return result, False
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
@@ -0,0 +1,133 @@
+import json
+from typing import Any
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import RunnableConfig
+
+from metrics import REGISTRY
+
+JSON_PARSE_FAILURES = REGISTRY.counter("datadiver_json_parse_failures_total",
+                                       "LLM answers that did not contain a valid JSON object, by model", ("llm",))
+JSON_EARLY_STOPS = REGISTRY.counter("datadiver_json_early_stops_total",
+                                    "Generations stopped as soon as a complete JSON object was emitted, by model",
+                                    ("llm",))
+
+
+class JsonObjectExtractor:
+    """
+    Incrementally finds the first complete JSON object of a text, ignoring any text around it (prose, code fences...).
+    Braces inside strings are ignored, so the object is known to be complete as soon as its closing brace is received
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._start = -1
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._position = 0
+        self.result: dict | None = None
+
+    def feed(self, chunk: str) -> dict | None:
+        """
+        Adds generated text to the extractor
+        :param chunk: The generated text
+        :return: The first complete JSON object, or None if no complete object was received yet
+        """
+        if self.result is not None:
+            return self.result
+
+        self.text += chunk
+        while self._position < len(self.text):
+            char = self.text[self._position]
+            self._position += 1
+
+            if self._start < 0:
+                if char == "{":
+                    self._start = self._position - 1
+                    self._depth = 1
+                continue
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        value = json.loads(self.text[self._start:self._position], strict=False)
+                    except json.JSONDecodeError:
+                        value = None
+                    if isinstance(value, dict):
+                        self.result = value
+                        return value
+                    # Not valid JSON (a brace in the prose for instance), look for the next object
+                    self._position = self._start + 1
+                    self._start = -1
+
+        return None
+
+
+def extract_json(text: str) -> dict | None:
+    """
+    Finds the first complete JSON object of a text
+    :param text: The text
+    :return: The object, or None if the text does not contain any
+    """
+    return JsonObjectExtractor().feed(text)
+
+
+def stream_json(llm: BaseChatModel, prompt: PromptValue, config: RunnableConfig | None = None) -> str:
+    """
+    Generates a JSON object, stopping the generation as soon as a complete object is emitted instead of waiting for
+    the model to finish any text it may add after it
+    :param llm: The model to use
+    :param prompt: The prompt to send
+    :param config: The runnable configuration, forwarded so that the callbacks see the generation
+    :return: The JSON object if one was generated, the whole generated text otherwise
+    """
+    extractor = JsonObjectExtractor()
+    stream = llm.stream(prompt, config)
+    try:
+        for chunk in stream:
+            if extractor.feed(chunk.content) is not None:
+                JSON_EARLY_STOPS.inc(llm=getattr(llm, "model", "unknown"))
+                return json.dumps(extractor.result, ensure_ascii=False)
+    finally:
+        # Closing the stream closes the connection, which makes Ollama stop generating
+        stream.close()
+
+    return extractor.text
+
+
+def parse_json_fields(text: str, llm: str, fields: dict[str, type | tuple[type, ...]],
+                      bounds: dict[str, tuple[float, float]] | None = None) -> dict[str, Any]:
+    """
+    Parses a generated JSON object and checks that it has the expected fields
+    :param text: The generated text
+    :param llm: The model that generated the text, used to count failures
+    :param fields: The expected field names and types
+    :param bounds: The inclusive (minimum, maximum) range of the numeric fields that have one
+    :return: The object
+    :raises ValueError if the text does not contain an object with the expected fields, or a value is out of range
+    """
+    value = extract_json(text)
+    if value is None or any(not isinstance(value.get(name), kind) or isinstance(value.get(name), bool)
+                            for name, kind in fields.items()):
+        JSON_PARSE_FAILURES.inc(llm=llm)
+        raise ValueError(f"Expected a JSON object with the fields {', '.join(fields)}")
+
+    for name, (minimum, maximum) in (bounds or {}).items():
+        if not minimum <= value[name] <= maximum:
+            JSON_PARSE_FAILURES.inc(llm=llm)
+            raise ValueError(f"Expected {name} to be between {minimum} and {maximum}, got {value[name]}")
+    return value
@@ -0,0 +1,307 @@
+import json
+import logging
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+from threading import Lock
+from typing import Any, Callable, Iterator
+from uuid import UUID, uuid4
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.outputs import LLMResult
+
+_current_trace: ContextVar["Trace | None"] = ContextVar("current_trace", default=None)
+
+# Run name of the search made for the raw question while it is rephrased, and event sent when its results are used
+SPECULATIVE_SEARCH = "speculative_search"
+SPECULATION_HIT = "speculation_hit"
+
+
+@dataclass
+class Span:
+    name: str
+    start_ms: float
+    duration_ms: float
+    attributes: dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class Trace:
+    trace_id: str
+    kind: str
+    # None for the requests that do not use a session
+    session_id: str | None
+    timestamp: str
+    duration_ms: float = 0.0
+    error: str | None = None
+    attributes: dict[str, Any] = field(default_factory=dict)
+    spans: list[Span] = field(default_factory=list)
+
+    def __post_init__(self):
+        self._origin = time.perf_counter()
+        self._lock = Lock()
+
+    def elapsed_ms(self) -> float:
+        """
+        Returns the time elapsed since the trace started
+        :return: The elapsed time in milliseconds
+        """
+        return (time.perf_counter() - self._origin) * 1000
+
+    def add_span(self, name: str, start: float, end: float, **attributes) -> Span:
+        """
+        Records a finished span. Thread safe, as LangChain may invoke callbacks from worker threads
+        :param name: The stage name
+        :param start: The perf_counter value at which the stage started
+        :param end: The perf_counter value at which the stage ended
+        :param attributes: Additional span attributes
+        :return: The recorded span
+        """
+        span = Span(name, (start - self._origin) * 1000, (end - start) * 1000, attributes)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def add_count(self, name: str, value: int) -> None:
+        """
+        Increments a numeric trace attribute (token counts, chunk counts...)
+        :param name: The attribute name
+        :param value: The value to add
+        """
+        with self._lock:
+            self.attributes[name] = self.attributes.get(name, 0) + value
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[dict[str, Any]]:
+        """
+        Times the enclosed block as a span. The yielded dict can be used to attach attributes to the span
+        :param name: The stage name
+        :param attributes: Initial span attributes
+        """
+        start = time.perf_counter()
+        try:
+            yield attributes
+        finally:
+            self.add_span(name, start, time.perf_counter(), **attributes)
+
+    def stage_durations(self) -> dict[str, float]:
+        """
+        Sums the span durations by stage name
+        :return: A dictionary of stage name -> total duration in milliseconds
+        """
+        durations: dict[str, float] = {}
+        with self._lock:
+            for span in self.spans:
+                durations[span.name] = durations.get(span.name, 0.0) + span.duration_ms
+        return durations
+
+    def to_dict(self) -> dict[str, Any]:
+        with self._lock:
+            return asdict(self)
+
+
+@contextmanager
+def current_span(name: str, **attributes) -> Iterator[dict[str, Any]]:
+    """
+    Times the enclosed block as a span of the trace active in the current context, if any
+    :param name: The stage name
+    :param attributes: Initial span attributes
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield attributes
+        return
+    with trace.span(name, **attributes) as attrs:
+        yield attrs
+
+
+@contextmanager
+def activate(trace: Trace) -> Iterator[Trace]:
+    """
+    Makes a trace the active trace of the current context, so that current_span and TracedEmbeddings record to it
+    :param trace: The trace to activate
+    """
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """
+    LangChain callback handler recording the rephrase, search, prompt and generate stages of a chain invocation
+    """
+
+    def __init__(self, trace: Trace):
+        self.trace = trace
+        self._runs: dict[UUID, tuple[str, float]] = {}
+        self._retrieved = False
+        self._lock = Lock()
+
+    def _start(self, run_id: UUID, name: str) -> None:
+        with self._lock:
+            self._runs[run_id] = (name, time.perf_counter())
+
+    def _end(self, run_id: UUID, **attributes) -> None:
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+        if run is not None:
+            self.trace.add_span(run[0], run[1], time.perf_counter(), **attributes)
+
+    def on_chat_model_start(self, serialized: dict[str, Any], messages: list, *, run_id: UUID, **kwargs) -> None:
+        # The history aware retriever only calls the LLM before retrieval, so any call made after is the answer
+        self._start(run_id, "generate" if self._retrieved else "rephrase")
+
+    def on_llm_start(self, serialized: dict[str, Any], prompts: list[str], *, run_id: UUID, **kwargs) -> None:
+        self._start(run_id, "generate" if self._retrieved else "rephrase")
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs) -> None:
+        prompt_tokens = 0
+        completion_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                info = generation.generation_info or {}
+                prompt_tokens += info.get("prompt_eval_count", 0) or 0
+                completion_tokens += info.get("eval_count", 0) or 0
+
+        self.trace.add_count("prompt_tokens", prompt_tokens)
+        self.trace.add_count("completion_tokens", completion_tokens)
+        self._end(run_id, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs) -> None:
+        # Generations streaming JSON are closed on purpose once the object is complete
+        if isinstance(error, GeneratorExit):
+            self._end(run_id)
+        else:
+            self._end(run_id, error=repr(error))
+
+    def on_retriever_start(self, serialized: dict[str, Any], query: str, *, run_id: UUID, **kwargs) -> None:
+        self._start(run_id, SPECULATIVE_SEARCH if kwargs.get("name") == SPECULATIVE_SEARCH else "search")
+
+    def on_retriever_end(self, documents: list[Document], *, run_id: UUID, **kwargs) -> None:
+        with self._lock:
+            run = self._runs.get(run_id)
+        # The speculative search runs alongside the rephrase, its results only count once they are used
+        if run is not None and run[0] != SPECULATIVE_SEARCH:
+            self._retrieved = True
+            self.trace.add_count("chunks", len(documents))
+        self._end(run_id, chunks=len(documents))
+
+    def on_retriever_error(self, error: BaseException, *, run_id: UUID, **kwargs) -> None:
+        self._end(run_id, error=repr(error))
+
+    def on_custom_event(self, name: str, data: Any, *, run_id: UUID, **kwargs) -> None:
+        if name == SPECULATION_HIT:
+            self._retrieved = True
+            self.trace.add_count("chunks", data["chunks"])
+
+    def on_chain_start(self, serialized: dict[str, Any], inputs: dict[str, Any], *, run_id: UUID, **kwargs) -> None:
+        if kwargs.get("run_type") == "prompt":
+            self._start(run_id, "prompt")
+
+    def on_chain_end(self, outputs: dict[str, Any], *, run_id: UUID, **kwargs) -> None:
+        self._end(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs) -> None:
+        self._end(run_id, error=repr(error))
+
+
+class TracedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper recording the time spent embedding as an 'embed' span of the active trace
+    """
+
+    def __init__(self, embeddings: Embeddings):
+        self.embeddings = embeddings
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        with current_span("embed", texts=len(texts)):
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        with current_span("embed", texts=1):
+            return self.embeddings.embed_query(text)
+
+
+class Tracer:
+    def __init__(self, buffer_size: int, log_path: str | None = None):
+        """
+        Tracer constructor. Finished traces are kept in a ring buffer and written as JSON lines to the log file
+        :param buffer_size: The number of traces to keep in memory
+        :param log_path: The structured log file path, or None to disable file logging
+        """
+        self._buffer: deque[Trace] = deque(maxlen=buffer_size)
+        self._lock = Lock()
+        self._listeners: list[Callable[[Trace], None]] = []
+        self._logger = logging.getLogger("datadiver.trace")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+
+        if log_path is not None and not self._logger.handlers:
+            directory = os.path.dirname(log_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._logger.addHandler(logging.FileHandler(log_path, encoding="utf-8"))
+
+    def add_listener(self, listener: Callable[[Trace], None]) -> None:
+        """
+        Registers a function called with every finished trace
+        :param listener: The function to call
+        """
+        self._listeners.append(listener)
+
+    @contextmanager
+    def trace(self, kind: str, session_id: str | None, **attributes) -> Iterator[Trace]:
+        """
+        Records a trace for the enclosed request. The trace is made available to TracedEmbeddings through the context
+        :param kind: The request kind (ask, evaluate...)
+        :param session_id: The session the request belongs to, None if it does not use one
+        :param attributes: Initial trace attributes
+        """
+        trace = Trace(str(uuid4()), kind, session_id, datetime.now().isoformat(), attributes=attributes)
+        try:
+            with activate(trace):
+                yield trace
+        except BaseException as e:
+            trace.error = repr(e)
+            raise
+        finally:
+            trace.duration_ms = trace.elapsed_ms()
+            self._record(trace)
+
+    def _record(self, trace: Trace) -> None:
+        with self._lock:
+            self._buffer.append(trace)
+
+        self._logger.info(json.dumps(trace.to_dict(), default=str))
+
+        for listener in self._listeners:
+            listener(trace)
+
+    def recent(self, count: int | None = None) -> list[Trace]:
+        """
+        Returns the most recent traces, newest last
+        :param count: The maximum number of traces to return, or None for all buffered traces
+        :return: The traces
+        """
+        with self._lock:
+            traces = list(self._buffer)
+        if count is None:
+            return traces
+        return traces[-count:] if count > 0 else []
+
+    @staticmethod
+    def callbacks(trace: Trace) -> list[BaseCallbackHandler]:
+        """
+        Creates the LangChain callbacks to pass to a chain invocation for a trace
+        :param trace: The trace to record to
+        :return: The callbacks list
+        """
+        return [TracingCallbackHandler(trace)]
@@ -1,61 +1,189 @@
+import argparse
 import os
 import sys
+from datetime import datetime
 from threading import Lock
 
 from colorama import Fore, Style
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from benchmarking import IngestionStats, TaskProfiler, host_info, write_results
+from budget import load_budget
+from catalogue import Catalogue, publisher_of
+from models import RetrievalMode
 from pipeline import Pipeline
 from config import Config
 
-def vectorize_all(path: str):
+RESULTS_DIRECTORY = "benchmarks/results"
+
+
+def make_splitter(mode: RetrievalMode) -> RecursiveCharacterTextSplitter:
+    """
+    Creates the splitter of a retrieval mode
+    :param mode: The retrieval mode
+    :return: The splitter. Parent retrieval embeds small chunks without overlap, as the LLM receives whole pages
+    """
+    if mode == RetrievalMode.parents:
+        return RecursiveCharacterTextSplitter(chunk_size=Config.child_chunk_size, chunk_overlap=0)
+    return RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=300)
+
+
+def vectorize_all(path: str, catalogue: Catalogue, workers: int = 8, profiler: TaskProfiler | None = None,
+                  mode: RetrievalMode = RetrievalMode.chunks) -> list[IngestionStats]:
     if not os.path.isdir(path):
         print(f"{Fore.RED}[-] The input path must be a directory{Style.RESET_ALL}")
-        return
+        return []
 
     lock = Lock()
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=300)
+    splitter = make_splitter(mode)
+    parents = Pipeline.make_parent_store() if mode == RetrievalMode.parents else None
+    results = []
 
     for retriever in Config.valid_retrievers:
         if retriever != "BAAI/bge-m3":
             print("skip")
             continue
         print(f"{Fore.CYAN}[*] Vectorizing {path} documents with size {Config.retrievers[retriever].embeddings_size}{Style.RESET_ALL}")
-        vectorstore = Pipeline.make_vectorstore(retriever)
-        Pipeline.load_all_pdfs(path, lock, splitter, vectorstore)
+        vectorstore = Pipeline.make_vectorstore(retriever, mode)
+        stats = IngestionStats(retriever)
+        Pipeline.load_all_pdfs(path, lock, splitter, vectorstore, workers, stats, profiler, catalogue, parents)
+        stats.finish()
+        results.append(stats)
+
+    return results
 
-def vectorize_single(file: str):
+def vectorize_single(file: str, catalogue: Catalogue, profiler: TaskProfiler | None = None,
+                     mode: RetrievalMode = RetrievalMode.chunks) -> list[IngestionStats]:
     if not os.path.isfile(file):
         print(f"{Fore.RED}[-] The input path must be a file{Style.RESET_ALL}")
-        return
+        return []
 
     if not file.endswith(".pdf"):
         print(f"{Fore.RED}[-] The provided file is not a pdf file{Style.RESET_ALL}")
-        return
-    
+        return []
+
     lock = Lock()
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=300)
+    splitter = make_splitter(mode)
+    parents = Pipeline.make_parent_store() if mode == RetrievalMode.parents else None
+    results = []
 
     for retriever in Config.valid_retrievers:
         print(f"{Fore.CYAN}[*] Vectorizing {file} with size {Config.retrievers[retriever].embeddings_size}{Style.RESET_ALL}")
-        vectorstore = Pipeline.make_vectorstore(retriever)
-        Pipeline.load_single_pdf(file, lock, splitter, vectorstore)
+        vectorstore = Pipeline.make_vectorstore(retriever, mode)
+        stats = IngestionStats(retriever)
+        Pipeline.load_single_pdf(file, lock, splitter, vectorstore, stats, profiler, catalogue, parents)
+        stats.finish()
+        results.append(stats)
+
+    return results
+
+def tag_vectorstores(catalogue: Catalogue, mode: RetrievalMode = RetrievalMode.chunks, batch_size: int = 5000) -> None:
+    """
+    Adds the publisher and document id metadata used by scoped retrieval to chunks stored before they existed
+    :param catalogue: The catalogue providing the document ids
+    :param mode: The retrieval mode whose index to tag
+    :param batch_size: The number of chunks updated at once
+    """
+    if len(catalogue) == 0:
+        catalogue.build(Config.resources_path)
+
+    for retriever in Config.valid_retrievers:
+        print(f"{Fore.CYAN}[*] Tagging the chunks of {retriever}{Style.RESET_ALL}")
+        collection = Pipeline.make_vectorstore(retriever, mode)._collection
+        offset = 0
+        missing = set()
+
+        while True:
+            batch = collection.get(include=["metadatas"], limit=batch_size, offset=offset)
+            if not batch["ids"]:
+                break
+
+            metadatas = []
+            for metadata in batch["metadatas"]:
+                metadata = dict(metadata)
+                metadata["publisher"] = publisher_of(metadata["source"])
+                entry = catalogue.resolve(metadata["source"])
+                if entry is not None:
+                    metadata["doc_id"] = entry.doc_id
+                else:
+                    missing.add(metadata["source"])
+                metadatas.append(metadata)
+
+            collection.update(ids=batch["ids"], metadatas=metadatas)
+            offset += len(batch["ids"])
+
+        print(f"{Fore.GREEN}[+] Tagged {offset} chunks{Style.RESET_ALL}")
+        for source in sorted(missing):
+            print(f"{Fore.YELLOW}[!] {source} is not catalogued, its chunks can only be scoped by publisher"
+                  f"{Style.RESET_ALL}")
+
+def print_summary(results: list[IngestionStats]) -> None:
+    print(f"\n{'retriever':<42}{'docs':>6}{'pages':>8}{'chunks':>8}{'pages/s':>10}{'chunks/s':>10}"
+          f"{'embeds/s':>10}{'writes/s':>10}{'lock s':>9}{'wall s':>9}")
+    for stats in results:
+        summary = stats.summary()
+        print(f"{summary['name']:<42}{summary['documents']:>6}{summary['pages']:>8}{summary['chunks']:>8}"
+              f"{summary['pages_per_second']:>10.1f}{summary['chunks_per_second']:>10.1f}"
+              f"{summary['embeddings_per_second']:>10.1f}{summary['writes_per_second']:>10.1f}"
+              f"{summary['stage_seconds']['lock_wait']:>9.1f}{summary['wall_seconds']:>9.1f}")
 
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python vectorize.py --single | --recurse <pdf_file | dir_path>")
+    parser = argparse.ArgumentParser(description="Vectorizes PDF documents into the vector databases. "
+                                                 "Run from the ai directory.")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--single", metavar="pdf_file", help="Vectorize a single document")
+    target.add_argument("--recurse", metavar="dir_path", help="Vectorize all documents recursively in directory")
+    target.add_argument("--tag", action="store_true",
+                        help="Add the publisher and document id metadata to the chunks of existing vector databases")
+    parser.add_argument("--mode", choices=[mode.value for mode in RetrievalMode], default=Config.retrieval_mode,
+                        help="The index to build: overlapping chunks, or small chunks linked to their pages "
+                             "(parents). Defaults to the RetrievalMode environment variable")
+    parser.add_argument("--workers", type=int, default=load_budget().ingestion_workers,
+                        help="Documents parsed and split concurrently. Defaults to the resource budget")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Print per-stage throughput and write it as JSON to benchmarks/results")
+    parser.add_argument("--profile", choices=["cprofile", "pyinstrument"], default=None,
+                        help="Profile the ingestion and write the report to benchmarks/results")
+    args = parser.parse_args()
+
+    profiler = TaskProfiler(args.profile) if args.profile is not None else None
+    workers = args.workers
+
+    # Python 3.12+ only allows a single active cProfile profiler at a time
+    if args.profile == "cprofile" and workers > 1 and sys.version_info >= (3, 12):
+        print(f"{Fore.YELLOW}[!] Profiling with a single worker on this Python version{Style.RESET_ALL}")
+        workers = 1
+
+    catalogue = Catalogue.load(Config.catalogue_path)
+    mode = RetrievalMode.from_value(args.mode)
+
+    if args.tag:
+        tag_vectorstores(catalogue, mode)
+        catalogue.save()
         return
-    
-    flag = sys.argv[1]
-    path = sys.argv[2]
-    
-    match flag:
-        case "--single":
-            pass
-        case "--recurse":
-            vectorize_all(path)
-        case _:
-            print(f"{Fore.RED}[-] Invalid flag. It must either be --single or --recurse{Style.RESET_ALL}")
-            return
-        
+
+    if args.single is not None:
+        results = vectorize_single(args.single, catalogue, profiler, mode)
+    else:
+        results = vectorize_all(args.recurse, catalogue, workers, profiler, mode)
+
+    catalogue.save()
+
+    if args.benchmark and results:
+        print_summary(results)
+        path = write_results(RESULTS_DIRECTORY, "ingest", {
+            "benchmark": "ingest",
+            "timestamp": datetime.now().isoformat(),
+            "host": host_info(),
+            "config": {"path": args.single or args.recurse, "workers": workers, "mode": mode.value},
+            "results": [stats.summary() for stats in results]
+        })
+        print(f"{Fore.GREEN}[+] Results written to {path}{Style.RESET_ALL}")
+
+    if profiler is not None:
+        path = profiler.write(RESULTS_DIRECTORY)
+        if path is not None:
+            print(f"{Fore.GREEN}[+] Profile written to {path}{Style.RESET_ALL}")
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
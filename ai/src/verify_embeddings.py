@@ -0,0 +1,151 @@
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+from colorama import Fore, Style
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from benchmarking import percentiles, host_info, write_results
+from config import Config
+from embeddings import BACKENDS, make_embeddings
+
+RESULTS_DIRECTORY = "benchmarks/results"
+
+
+def load_corpus(path: str, samples: int, seed: int = 0) -> list[str]:
+    """
+    Samples chunks of the bundled documents, split as they are for the vector databases
+    :param path: The resources directory
+    :param samples: The number of chunks to sample
+    :param seed: The sampling seed, so that runs can be compared
+    :return: The chunk texts
+    """
+    from langchain_community.document_loaders import PyPDFLoader
+
+    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=300)
+    texts = []
+    for root, directories, files in os.walk(path):
+        directories.sort()
+        for file in sorted(files):
+            if not file.endswith(".pdf"):
+                continue
+            try:
+                pages = PyPDFLoader(os.path.join(root, file)).load()
+            except Exception as e:
+                print(f"{Fore.YELLOW}[!] Skipping {file}: {e}{Style.RESET_ALL}")
+                continue
+            texts.extend(document.page_content for document in splitter.split_documents(pages))
+
+    if len(texts) > samples:
+        texts = random.Random(seed).sample(texts, samples)
+    return texts
+
+
+def embed(embeddings, texts: list[str], queries: list[str]) -> tuple[list[list[float]], float, list[float]]:
+    """
+    Embeds the corpus in one batch, as the ingestion does, then each query on its own, as the searches do
+    :return: A tuple containing the corpus embeddings, the corpus embedding time and the query latencies (ms)
+    """
+    embeddings.embed_documents(texts[:8])
+
+    start = time.perf_counter()
+    vectors = embeddings.embed_documents(texts)
+    elapsed = time.perf_counter() - start
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        embeddings.embed_query(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    return vectors, elapsed, latencies
+
+
+def compare(reference: list[list[float]], candidate: list[list[float]], queries: int, k: int) -> dict:
+    """
+    Compares the embeddings of two backends
+    :param reference: The embeddings of the float model
+    :param candidate: The embeddings of the backend to verify
+    :param queries: The number of chunks used as queries for the neighbour agreement
+    :param k: The number of neighbours compared
+    :return: The cosine similarity between the embeddings of each chunk and the overlap of the nearest neighbours
+    """
+    import torch
+
+    reference = torch.nn.functional.normalize(torch.tensor(reference), dim=1)
+    candidate = torch.nn.functional.normalize(torch.tensor(candidate), dim=1)
+    cosines = (reference * candidate).sum(dim=1).tolist()
+
+    # Searching the corpus with the first chunks should find the same neighbours with both backends
+    k = min(k, len(reference))
+    expected = (reference[:queries] @ reference.T).topk(k, dim=1).indices.tolist()
+    found = (candidate[:queries] @ candidate.T).topk(k, dim=1).indices.tolist()
+    overlaps = [len(set(a) & set(b)) / k for a, b in zip(expected, found)]
+
+    return {
+        "cosine": {"min": min(cosines), "mean": sum(cosines) / len(cosines)},
+        "k": k,
+        "neighbour_overlap": sum(overlaps) / len(overlaps) if overlaps else 0.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks that an embedding backend agrees with the float model on "
+                                                 "the bundled documents and compares their speed. "
+                                                 "Run from the ai directory.")
+    parser.add_argument("--retriever", choices=Config.valid_retrievers, default=Config.valid_retrievers[2])
+    parser.add_argument("--backend", choices=[backend for backend in BACKENDS if backend != "torch"], default="int8")
+    parser.add_argument("--resources", default=Config.resources_path, help="The directory containing the documents")
+    parser.add_argument("--samples", type=int, default=500, help="The number of chunks compared")
+    parser.add_argument("--queries", type=int, default=50, help="The number of chunks used as queries")
+    parser.add_argument("--k", type=int, default=10, help="The number of neighbours compared")
+    parser.add_argument("--threshold", type=float, default=0.98,
+                        help="The minimum cosine similarity between the embeddings of the two backends")
+    parser.add_argument("--output", default=None, help="The JSON results path")
+    args = parser.parse_args()
+
+    texts = load_corpus(args.resources, args.samples)
+    if not texts:
+        print(f"{Fore.RED}[-] No document could be read in {args.resources}{Style.RESET_ALL}", file=sys.stderr)
+        sys.exit(1)
+    queries = texts[:args.queries]
+    print(f"{Fore.CYAN}[*] Comparing {len(texts)} chunks{Style.RESET_ALL}", flush=True)
+
+    results = {}
+    vectors = {}
+    for backend in ("torch", args.backend):
+        vectors[backend], elapsed, latencies = embed(make_embeddings(args.retriever, backend), texts, queries)
+        results[backend] = {"corpus_seconds": elapsed, "chunks_per_second": len(texts) / elapsed,
+                            "query_latency_ms": percentiles(latencies)}
+        print(f"{Fore.GREEN}[+] {backend}: {len(texts) / elapsed:.1f} chunks/s, "
+              f"query p50 {results[backend]['query_latency_ms']['p50']:.1f} ms{Style.RESET_ALL}", flush=True)
+
+    agreement = compare(vectors["torch"], vectors[args.backend], args.queries, args.k)
+    passed = agreement["cosine"]["min"] >= args.threshold
+
+    path = write_results(RESULTS_DIRECTORY, "embeddings", {
+        "benchmark": "embeddings",
+        "timestamp": datetime.now().isoformat(),
+        "host": host_info(),
+        "config": {"retriever": args.retriever, "backend": args.backend, "samples": len(texts),
+                   "threshold": args.threshold},
+        "results": results,
+        "agreement": agreement,
+        "passed": passed
+    }, args.output)
+
+    color = Fore.GREEN if passed else Fore.RED
+    print(f"{color}[{'+' if passed else '-'}] Cosine min {agreement['cosine']['min']:.4f}, "
+          f"mean {agreement['cosine']['mean']:.4f}, neighbour overlap "
+          f"at {agreement['k']} {agreement['neighbour_overlap']:.2f}{Style.RESET_ALL}")
+    print(f"{Fore.GREEN}[+] Results written to {path}{Style.RESET_ALL}")
+
+    if not passed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,35 @@
+from __future__ import annotations
+
 import os
+import socket
 import sys
+import time
 import traceback
-from dataclasses import asdict
-from typing import Callable, Type
+from dataclasses import asdict, replace
+from threading import Thread
+from typing import Callable, Type, TYPE_CHECKING
 
 import requests
 import waitress
 from colorama import Fore, Style
-from flask import Flask, request, send_from_directory
+from flask import Flask, Response, g, request, send_file, send_from_directory
 from pymongo.errors import ConnectionFailure
-from werkzeug.exceptions import UnsupportedMediaType, BadRequest, NotFound, MethodNotAllowed
+from werkzeug.exceptions import UnsupportedMediaType, BadRequest, NotFound, MethodNotAllowed, ServiceUnavailable
+from werkzeug.security import safe_join
 
+import metrics
 from config import Config
-from models import custom_asdict, AlgorithmType, SessionType
-from pipeline import Pipeline, SSTParams, MMRParams, SimilarityParams
-from responses import internal_server_error, ok, bad_request, unsupported_media, not_found, method_not_allowed
+from page_cache import PageCache, parse_pages
+from models import custom_asdict, AlgorithmType, SessionType, SSTParams, MMRParams, SimilarityParams, \
+    MemoryParams, MemoryType, RetrievalScope
+from responses import internal_server_error, ok, bad_request, unsupported_media, not_found, method_not_allowed, \
+    service_unavailable
 from restrictions import require_type, require_bound, require_unit
 
+# The pipeline module pulls LangChain and is loaded in the background, after the server started listening
+if TYPE_CHECKING:
+    from pipeline import Pipeline
+
 
 def simplify_path(directory: str, full_path: str) -> str:
     directory = os.path.normpath(directory)
@@ -34,15 +47,94 @@ def simplify_path(directory: str, full_path: str) -> str:
 
 class WebHandler:
 
-    def __init__(self, name: str, pipeline: Pipeline):
+    def __init__(self, name: str, pipeline: Pipeline | None = None, started: float | None = None,
+                 worker: int | None = None):
+        """
+        WebHandler constructor
+        :param name: The Flask application name
+        :param pipeline: The pipeline to serve. If None, the service is not ready until start_warm_up completes
+        :param started: The perf_counter value at which the process started, used to measure the startup time
+        :param worker: The index of the worker serving the application in the pre-fork mode, None otherwise
+        """
         self.app = Flask(name)
-        self.pipeline = pipeline
+        self.worker = worker
+        self._pipeline = pipeline
+        self._started = started if started is not None else time.perf_counter()
+        self._stage = "ready" if pipeline is not None else "starting"
+        self.page_cache = PageCache(Config.page_cache_path, Config.page_cache_size)
+        self.app.before_request(WebHandler.start_request_timer)
+        self.app.after_request(WebHandler.record_request_metrics)
+        metrics.ACTIVE_SESSIONS.set_function(lambda: len(self._pipeline.mem_history) if self._pipeline else 0)
+        metrics.HISTORY_MESSAGES.set_function(
+            lambda: sum(len(history) for history in list(self._pipeline.mem_history.values()))
+            if self._pipeline else 0)
+        metrics.EMBEDDING_MODELS.set_function(lambda: len(self._pipeline.loaded_retrievers()) if self._pipeline else 0)
+
+    @property
+    def pipeline(self) -> Pipeline:
+        """
+        The served pipeline
+        :raises ServiceUnavailable if the pipeline is still loading
+        """
+        if self._pipeline is None or self._stage != "ready":
+            raise ServiceUnavailable(f"The service is not ready yet ({self._stage})")
+        if self._pipeline.shared_state and not g.get("state_synced"):
+            # Once per request, so that the request sees the changes made by the other workers
+            g.state_synced = True
+            self._pipeline.sync_shared_state()
+        return self._pipeline
+
+    def start_warm_up(self, factory: Callable[[], Pipeline]) -> None:
+        """
+        Creates and warms up the pipeline in the background. The service reports ready once done
+        :param factory: The function creating the pipeline
+        """
+        Thread(target=self._warm_up, args=(factory,), name="warm-up", daemon=True).start()
+
+    def _warm_up(self, factory: Callable[[], Pipeline]) -> None:
+        try:
+            self._stage = "loading pipeline"
+            pipeline = factory()
+            self._pipeline = pipeline
+            self._stage = "warming up models"
+            pipeline.warm_up()
+            self._stage = "ready"
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            self._stage = f"failed: {e}"
+            return
+
+        time_to_ready = time.perf_counter() - self._started
+        metrics.STARTUP_SECONDS.set(time_to_ready, phase="ready")
+        print(f"{Fore.GREEN}[+] Service ready in {time_to_ready:.2f}s{Style.RESET_ALL}", flush=True)
+
+    def run(self, sockets: list[socket.socket] | None = None):
+        """
+        Registers the endpoints and serves the application until the process stops
+        :param sockets: Listening sockets to serve, shared by the workers of the pre-fork mode. Defaults to listening
+        on the configured port
+        """
+        self.register()
 
-    def run(self):
+        print(f"{Fore.CYAN}[*] MongoDB path: {Config.mongo_path}{Style.RESET_ALL}", flush=True)
+
+        if sockets is not None:
+            server = waitress.create_server(self.app, sockets=sockets)
+        else:
+            # Listen on all addresses using the configured port
+            server = waitress.create_server(self.app, host="0.0.0.0", port=Config.listen_port)
+        time_to_bind = time.perf_counter() - self._started
+        metrics.STARTUP_SECONDS.set(time_to_bind, phase="bind")
+        print(f"{Fore.GREEN}[+] Listening on port {Config.listen_port} after {time_to_bind:.2f}s{Style.RESET_ALL}",
+              flush=True)
+        server.run()
+
+    def register(self):
 
         ##### URL Endpoints ####
 
         # Retrieve session configuration and history. Arguments (URL): id
+        # Arguments (Query): offset -> int, limit -> int (optional, paginates the evaluation answers)
         self.add_endpoint("/session/<string:session_id>", self.get_session, ["GET"])
 
         # Uses a session by its ID. Arguments (URL): id
@@ -54,16 +146,36 @@ class WebHandler:
         # Uses a different llm. Arguments (URL): llm
         self.add_endpoint("/llm/<string:llm>", self.use_llm, ["POST"])
 
-        # Retrieves a source document. Arguments (URL): document
+        # Retrieves a source document. Supports range requests and caching. Arguments (URL): document
+        # Arguments (Query): pages -> str (optional, e.g. 3,4 or 3-5, only returns these pages),
+        # format -> str (optional, pdf or text, defaults to pdf)
         self.add_endpoint("/document/<path:document>", self.get_document, ["GET"])
 
+        # Retrieves a source document by its catalogue id. Arguments (URL): doc_id. Arguments (Query): pages, format
+        self.add_endpoint("/document/id/<int:doc_id>", self.get_document_by_id, ["GET"])
+
+        # Returns the document catalogue (id, path, pages, title, global page offset, size). Arguments: None
+        self.add_endpoint("/documents", self.get_documents, ["GET"])
+
         # Returns all the existing sessions. Arguments: None
         self.add_endpoint("/sessions", self.get_sessions, ["GET"])
 
+        # Liveness probe, succeeds as soon as the server listens unless the startup failed. Arguments: None
+        self.add_endpoint("/health", self.get_health, ["GET"])
+
+        # Readiness probe, succeeds once the pipeline and models are loaded. Arguments: None
+        self.add_endpoint("/ready", self.get_ready, ["GET"])
+
+        # Returns the service metrics using the Prometheus text format. Arguments: None
+        self.add_endpoint("/metrics", self.get_metrics, ["GET"])
+
+        # Returns the most recent request traces. Arguments (Query): count -> int (optional)
+        self.add_endpoint("/traces", self.get_traces, ["GET"])
+
         ##### JSON Endpoints ####
 
         # Updates the current session configuration. Arguments (JSON): name -> str,
-        # llm -> str, retriever -> str, alg -> str, params...
+        # llm -> str, retriever -> str, alg -> str, params..., memory -> str (optional), memory_size -> int (optional)
         self.add_endpoint("/config", self.update_config, ["POST"])
 
         # Uses a different llm. Arguments (JSON): retriever -> str
@@ -72,15 +184,37 @@ class WebHandler:
         # Enables similarity score threshold mode. Arguments (JSON): algorithm -> str, params...
         self.add_endpoint("/algorithm", self.use_algorithm, ["POST"])
 
-        # Main endpoint, used to ask a question. Arguments (JSON): question -> str
+        # Updates the part of the chat history sent to the model. Arguments (JSON): memory -> str
+        # (full, window, tokens or summary), memory_size -> int (optional, turns or tokens)
+        self.add_endpoint("/memory", self.use_memory, ["POST"])
+
+        # Restricts the retrieval of the session to publishers and documents. Arguments (JSON):
+        # publishers -> list[str] (optional), documents -> list[int] (optional, catalogue ids). Empty to search all
+        self.add_endpoint("/scope", self.use_scope, ["POST"])
+
+        # Main endpoint, used to ask a question. Arguments (JSON): question -> str,
+        # publishers -> list[str] (optional), documents -> list[int] (optional) restrict retrieval for this question
         # Requires to use a session with /session or /create_session before calling
         self.add_endpoint("/ask", self.ask, ["POST"])
 
-        # Main endpoint, used to evaluate an answer. Arguments (JSON): question -> str
+        # Main endpoint, used to evaluate an answer. Arguments (JSON): criterion -> str, answer -> str,
+        # publishers -> list[str] (optional), documents -> list[int] (optional),
+        # force -> bool (optional, grades the answer again instead of using the grade cache)
         self.add_endpoint("/eval", self.eval, ["POST"])
 
+        # Searches the documents without generating an answer, no session is required. Arguments (JSON):
+        # query -> str, retriever -> str, algorithm -> str, params..., publishers -> list[str] (optional),
+        # documents -> list[int] (optional). Returns the chunks found with their doc_id, page, score and content
+        self.add_endpoint("/search", self.search, ["POST"])
+
+        # Searches the documents for several queries, embedded in a single batch. Arguments (JSON):
+        # queries -> list[str], retriever -> str, algorithm -> str, params..., publishers -> list[str] (optional),
+        # documents -> list[int] (optional). Returns the chunks found for each query, in the order of the queries
+        self.add_endpoint("/search/batch", self.search_batch, ["POST"])
+
         # Creates a new chat session, activates and returns its ID. Arguments (JSON): name -> str,
-        # type -> str, llm -> str, retriever -> str, alg -> str, params...
+        # type -> str, llm -> str, retriever -> str, alg -> str, params..., memory -> str (optional),
+        # memory_size -> int (optional)
         self.add_endpoint("/new_session", self.new_session, ["POST"])
 
         self.add_endpoint("/criteria", self.use_criteria, ["POST"])
@@ -98,16 +232,12 @@ class WebHandler:
         self.add_error_handler(BadRequest, WebHandler.handle_bad_request)
         self.add_error_handler(NotFound, WebHandler.handle_not_found)
         self.add_error_handler(MethodNotAllowed, WebHandler.handle_not_allowed)
+        self.add_error_handler(ServiceUnavailable, WebHandler.handle_service_unavailable)
         self.add_error_handler(ConnectionFailure, WebHandler.mongo_connection_failure)
 
         # Fallback exception handler. Prints a stacktrace and returns an internal server error
         self.add_error_handler(Exception, WebHandler.handle_exception)
 
-        print(f"{Fore.CYAN}[*] MongoDB path: {Config.mongo_path}{Style.RESET_ALL}", flush=True)
-
-        # Listen on all addresses using the configured port
-        waitress.serve(self.app, host="0.0.0.0", port=Config.listen_port)
-
     def add_endpoint(self, endpoint: str, handler: Callable, methods: list[str]):
         self.app.add_url_rule(endpoint, None, handler, methods=methods)
 
@@ -117,7 +247,7 @@ class WebHandler:
     def ask(self):
         try:
             data = request.get_json()
-            sources, answer = self.pipeline.ask(require_type(data, 'question', str))
+            sources, answer = self.pipeline.ask(require_type(data, 'question', str), self.optional_scope(data))
             return ok("Generated answer", additional={"answer": answer, "sources": sources})
         except requests.exceptions.ConnectionError:
             print(f"{Fore.RED}[-] Could not reach ollama, is the service running?{Style.RESET_ALL}", file=sys.stderr)
@@ -128,12 +258,37 @@ class WebHandler:
             data = request.get_json()
             criterion = require_type(data, 'criterion', str)
             answer = require_type(data, 'answer', str)
-            result = self.pipeline.evaluate(criterion, answer)
+            force = require_type(data, 'force', bool) if 'force' in data else False
+            result = self.pipeline.evaluate(criterion, answer, self.optional_scope(data), force)
             return ok("Generated answer", additional={"result": result})
         except requests.exceptions.ConnectionError:
             print(f"{Fore.RED}[-] Could not reach ollama, is the service running?{Style.RESET_ALL}", file=sys.stderr)
             return internal_server_error()
 
+    def search(self):
+        data = request.get_json()
+        query = require_type(data, "query", str)
+        results = self.run_search(data, [query])[0]
+        return ok(f"Found {len(results)} chunks", {"results": results})
+
+    def search_batch(self):
+        data = request.get_json()
+        queries = require_type(data, "queries", list)
+
+        if not all(isinstance(query, str) for query in queries):
+            raise TypeError("The queries must be strings")
+        if len(queries) > Config.max_search_queries:
+            raise ValueError(f"At most {Config.max_search_queries} queries can be searched at once")
+
+        results = self.run_search(data, queries)
+        return ok(f"Searched {len(queries)} queries", {"results": results})
+
+    def run_search(self, data: dict, queries: list[str]) -> list[list[dict]]:
+        retriever = require_type(data, "retriever", str)
+        alg = AlgorithmType.from_value(require_type(data, 'algorithm', str))
+        params = self.require_valid_parameters(data, alg)
+        return self.pipeline.search(queries, retriever, alg, params, self.optional_scope(data))
+
     def delete_session(self, session_id: str):
         if not self.pipeline.session_exists(session_id):
             raise ValueError(f"The session '{session_id}' does not exist")
@@ -148,8 +303,52 @@ class WebHandler:
         return ok(f"Now using session {self.pipeline.session_config.id}")
 
     def get_document(self, document: str):
-        doc = simplify_path("resources", document)
-        return send_from_directory("resources", doc)
+        entry = self.pipeline.catalogue.resolve(document)
+        doc = entry.path if entry is not None else simplify_path(Config.resources_path, document)
+
+        if "pages" in request.args:
+            return self.send_pages(doc, entry.pages if entry is not None else None)
+
+        return send_from_directory(Config.resources_path, doc, max_age=Config.document_max_age)
+
+    def get_document_by_id(self, doc_id: int):
+        entry = self.pipeline.catalogue.get(doc_id)
+
+        if entry is None:
+            raise NotFound(f"The document {doc_id} does not exist")
+
+        if "pages" in request.args:
+            return self.send_pages(entry.path, entry.pages)
+
+        return send_from_directory(Config.resources_path, entry.path, max_age=Config.document_max_age)
+
+    def send_pages(self, document: str, page_count: int | None = None):
+        """
+        Sends the pages of a document selected by the pages query argument, as a PDF document or as text
+        :param document: The document path, relative to the resources directory
+        :param page_count: The number of pages of the document from the catalogue, None if it is not catalogued
+        """
+        path = safe_join(Config.resources_path, document)
+        if path is None or not os.path.isfile(path):
+            raise NotFound(f"The document '{document}' does not exist")
+
+        kind = request.args.get("format", default="pdf")
+        if kind not in ("pdf", "text"):
+            raise ValueError(f"Invalid format: '{kind}', expected pdf or text")
+
+        pages = parse_pages(request.args["pages"], Config.max_extracted_pages, page_count)
+        file, etag = self.page_cache.get(path, pages, kind)
+        name = os.path.splitext(os.path.basename(document))[0] + f"-{pages[0]}-{pages[-1]}"
+
+        return send_file(file,
+                         mimetype="application/pdf" if kind == "pdf" else "application/json",
+                         download_name=f"{name}.pdf" if kind == "pdf" else f"{name}.json",
+                         etag=etag,
+                         max_age=Config.document_max_age)
+
+    def get_documents(self):
+        documents = [asdict(entry) for entry in self.pipeline.catalogue.entries()]
+        return ok(f"Retrieved {len(documents)} documents", {"documents": documents})
 
     def use_algorithm(self):
         data = request.get_json()
@@ -168,18 +367,28 @@ class WebHandler:
         if not session:
             raise ValueError(f"The session '{session_id}' does not exist")
 
-        if self.pipeline.session_config.session_type == SessionType.chat:
+        if session.session_type == SessionType.chat:
             return ok(f"Retrieved session configuration", {"session": {
                 "config": asdict(session, dict_factory=custom_asdict),
                 "history": self.pipeline.dump_history(session_id)
             }})
         else:
+            offset = request.args.get("offset", default=0, type=int)
+            limit = request.args.get("limit", default=None, type=int)
+
+            if offset < 0 or (limit is not None and limit < 0):
+                raise ValueError("The offset and limit must be positive")
+
+            self.pipeline.flush_writes()
+
             return ok(f"Retrieved session configuration", {"session": {
                 "config": asdict(session, dict_factory=custom_asdict),
-                "data": self.pipeline.mongodb.get_evaluation_data(session_id)
+                "data": self.pipeline.mongodb.get_evaluation_data(session_id, offset, limit),
+                "total_answers": self.pipeline.mongodb.count_answers(session_id)
             }})
 
     def get_sessions(self):
+        self.pipeline.flush_writes()
         sessions = self.pipeline.mongodb.get_sessions()
         my_dict = dict()
         for session_id in sessions:
@@ -197,6 +406,41 @@ class WebHandler:
                 
         return ok(f"Retrieved sessions", {"sessions": my_dict})
 
+    @staticmethod
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @staticmethod
+    def record_request_metrics(response: Response) -> Response:
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        metrics.REQUESTS.inc(endpoint=endpoint, method=request.method, status=str(response.status_code))
+        if "request_start" in g:
+            metrics.REQUEST_LATENCY.observe(time.perf_counter() - g.request_start, endpoint=endpoint,
+                                            method=request.method)
+        return response
+
+    def get_health(self):
+        if self._stage.startswith("failed"):
+            return service_unavailable(f"The service failed to start ({self._stage})")
+        return ok("Alive", {"stage": self._stage})
+
+    def get_ready(self):
+        if self._stage != "ready":
+            return service_unavailable(f"The service is not ready yet ({self._stage})", {"stage": self._stage})
+        return ok("Ready", {"stage": self._stage})
+
+    @staticmethod
+    def get_metrics():
+        return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+    def get_traces(self):
+        count = request.args.get("count", default=None, type=int)
+        if count is not None and count < 1:
+            raise ValueError(f"Invalid trace count: {count}, expected a positive number")
+        traces = [trace.to_dict() for trace in self.pipeline.tracer.recent(count)]
+        # Each pre-fork worker only buffers the traces of the requests it served
+        return ok(f"Retrieved {len(traces)} traces", {"traces": traces, "worker": self.worker})
+
     def use_retriever(self):
         data = request.get_json()
         retriever = require_type(data, "retriever", str)
@@ -211,8 +455,9 @@ class WebHandler:
         retriever = require_type(data, "retriever", str)
         alg = AlgorithmType.from_value(require_type(data, 'algorithm', str))
         params = self.require_valid_parameters(data, alg)
+        memory = self.require_valid_memory(data) if "memory" in data else None
 
-        self.pipeline.create_and_use_session(name, session_type, llm, retriever, alg, params)
+        self.pipeline.create_and_use_session(name, session_type, llm, retriever, alg, params, memory)
         return ok(f"Now using session {self.pipeline.session_config.id}",
                   {"session_id": self.pipeline.session_config.id})
 
@@ -228,6 +473,17 @@ class WebHandler:
         self.pipeline.use_scenario(scenario)
         return ok("Updated the criteria")
 
+    def use_scope(self):
+        data = request.get_json()
+        self.pipeline.use_scope(self.require_valid_scope(data))
+        return ok("Updated the retrieval scope")
+
+    def use_memory(self):
+        data = request.get_json()
+        memory = self.require_valid_memory(data)
+        self.pipeline.use_memory(memory)
+        return ok(f"Using {memory.strategy.value} memory")
+
     def update_config(self):
         data = request.get_json()
         name = require_type(data, "name", str)
@@ -236,10 +492,15 @@ class WebHandler:
         alg = AlgorithmType.from_value(require_type(data, 'algorithm', str))
         params = self.require_valid_parameters(data, alg)
 
-        self.pipeline.use_name(name)
-        self.pipeline.use_algorithm(alg, params)
-        self.pipeline.use_llm(llm)
-        self.pipeline.use_retriever(retriever)
+        self.pipeline.ensure_valid()
+        config = replace(self.pipeline.session_config, display_name=name, llm_name=llm, retriever_name=retriever,
+                         algorithm_type=alg, algorithm_params=params)
+
+        if "memory" in data:
+            config = replace(config, memory=self.require_valid_memory(data))
+
+        # Applied at once so that only the changed components are rebuilt and the configuration is saved once
+        self.pipeline.update_config(config)
 
         return ok(f"Updated configuration for session {self.pipeline.session_config.id}")
 
@@ -253,6 +514,31 @@ class WebHandler:
             case AlgorithmType.mmr:
                 return MMRParams(require_bound(data, 'fetch_k', range(3, 100)), require_unit(data, "lambda_mult"))
 
+    @staticmethod
+    def require_valid_scope(data: dict) -> RetrievalScope:
+        publishers = require_type(data, "publishers", list) if "publishers" in data else []
+        documents = require_type(data, "documents", list) if "documents" in data else []
+
+        if not all(isinstance(publisher, str) for publisher in publishers):
+            raise TypeError("The publishers must be strings")
+        if not all(isinstance(doc_id, int) for doc_id in documents):
+            raise TypeError("The documents must be catalogue ids")
+
+        return RetrievalScope(publishers, documents)
+
+    @staticmethod
+    def optional_scope(data: dict) -> RetrievalScope | None:
+        if "publishers" not in data and "documents" not in data:
+            return None
+        return WebHandler.require_valid_scope(data)
+
+    @staticmethod
+    def require_valid_memory(data: dict) -> MemoryParams:
+        strategy = MemoryType.from_value(require_type(data, "memory", str))
+        if "memory_size" not in data:
+            return MemoryParams.new(strategy)
+        return MemoryParams.new(strategy, require_bound(data, "memory_size", range(1, 131072)))
+
     @staticmethod
     def handle_exception(e: Exception):
         traceback.print_exc(file=sys.stderr)
@@ -290,6 +576,12 @@ class WebHandler:
     def handle_not_allowed(e: MethodNotAllowed):
         return method_not_allowed(e.description)
 
+    @staticmethod
+    def handle_service_unavailable(e: ServiceUnavailable):
+        response, code = service_unavailable(e.description)
+        response.headers["Retry-After"] = "5"
+        return response, code
+
     @staticmethod
     def mongo_connection_failure(e: ConnectionFailure):
         print("[-] Failed to connect to MongoDB", file=sys.stderr)
@@ -0,0 +1,205 @@
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+from threading import Thread
+
+from colorama import Fore, Style
+from pymongo.errors import ConnectionFailure
+
+from config import Config
+from metrics import REGISTRY
+
+
+class PreforkServer:
+    """
+    Serves the application from several processes accepting connections on the same socket. The embedding models and
+    vector indexes are loaded once by the parent process and the workers are forked from it, so that they share
+    these pages copy-on-write instead of loading their own copy. The active session and the histories are shared
+    through MongoDB, so that any worker can serve any request
+    """
+
+    def __init__(self, workers: int, started: float):
+        """
+        PreforkServer constructor
+        :param workers: The number of worker processes
+        :param started: The perf_counter value at which the process started, used to measure the startup time
+        """
+        self.workers = workers
+        self.started = started
+        self._children: dict[int, int] = {}
+        self._stopping = False
+
+    def run(self) -> None:
+        """
+        Loads the models, starts the workers and restarts the ones that exit until the server is stopped
+        """
+        if not hasattr(os, "fork"):
+            raise RuntimeError("The pre-fork mode requires fork, set Workers to 1 on this platform")
+
+        # Bound before loading the models so that connections queue instead of being refused during the startup
+        listener = socket.create_server(("0.0.0.0", Config.listen_port), backlog=1024)
+        print(f"{Fore.GREEN}[+] Listening on port {Config.listen_port} with {self.workers} workers{Style.RESET_ALL}",
+              flush=True)
+
+        PreforkServer.reset_shared_state()
+        REGISTRY.reset_shared(Config.metrics_path)
+        vectorstores = PreforkServer.preload()
+        print(f"{Fore.GREEN}[+] Models preloaded after {time.perf_counter() - self.started:.2f}s{Style.RESET_ALL}",
+              flush=True)
+
+        # The collector would otherwise write to the pages of every object it visits, copying them in each worker
+        gc.collect()
+        gc.freeze()
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for slot in range(self.workers):
+            self.spawn(slot, listener, vectorstores)
+
+        self.supervise(listener, vectorstores)
+
+    @staticmethod
+    def reset_shared_state() -> None:
+        """
+        Clears the session left active by a previous run. The client is closed before forking, as MongoDB clients
+        cannot be shared with child processes
+        """
+        from mongodb import MongoDatabase
+
+        database = MongoDatabase()
+        try:
+            database.reset_shared_state()
+        except ConnectionFailure:
+            print(f"{Fore.RED}[-] Failed to connect to MongoDB{Style.RESET_ALL}", file=sys.stderr)
+        finally:
+            database.client.close()
+
+    @staticmethod
+    def preload() -> dict:
+        """
+        Loads the vectorstores of the warm-up retrievers in the parent process
+        :return: The vectorstores by retriever name, empty if they could not be loaded
+        """
+        from pipeline import Pipeline
+
+        try:
+            vectorstores = Pipeline.preload_vectorstores()
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            print(f"{Fore.RED}[-] Failed to preload the models, each worker loads its own{Style.RESET_ALL}",
+                  file=sys.stderr)
+            return {}
+        return vectorstores
+
+    def spawn(self, slot: int, listener: socket.socket, vectorstores: dict) -> None:
+        """
+        Forks a worker
+        :param slot: The index of the worker
+        :param listener: The listening socket
+        :param vectorstores: The preloaded vectorstores
+        """
+        pid = os.fork()
+        if pid != 0:
+            self._children[pid] = slot
+            return
+
+        code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            PreforkServer.serve(slot, listener, vectorstores, self.started)
+        except SystemExit:
+            pass
+        except BaseException:
+            traceback.print_exc(file=sys.stderr)
+            code = 1
+        finally:
+            # Skips the exit handlers inherited from the parent process
+            os._exit(code)
+
+    @staticmethod
+    def serve(slot: int, listener: socket.socket, vectorstores: dict, started: float) -> None:
+        """
+        Serves the application in a worker
+        """
+        from budget import apply_torch_budget, load_budget
+        from pipeline import Pipeline
+        from web_handler import WebHandler
+
+        if "torch" in sys.modules:
+            # The thread count set by the parent is not inherited by the thread pools of the child
+            apply_torch_budget(load_budget())
+
+        pipelines = []
+
+        def create_pipeline():
+            pipeline = Pipeline(vectorstores=vectorstores, shared_state=True)
+            pipelines.append(pipeline)
+            return pipeline
+
+        print(f"{Fore.CYAN}[*] Worker {slot} started (pid {os.getpid()}){Style.RESET_ALL}", flush=True)
+        # Each scrape lands on one worker, which reports the metrics of all of them
+        REGISTRY.share(Config.metrics_path, str(slot), Config.metrics_flush_interval)
+        handler = WebHandler("ai_service", started=started, worker=slot)
+        handler.start_warm_up(create_pipeline)
+        try:
+            handler.run([listener])
+        finally:
+            # The pending background writes of the worker are committed before it exits
+            for pipeline in pipelines:
+                pipeline.flush_writes()
+            REGISTRY.flush()
+
+    def supervise(self, listener: socket.socket, vectorstores: dict) -> None:
+        """
+        Waits for the workers, restarting the ones that exit until the server is stopped
+        """
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            slot = self._children.pop(pid, None)
+            if slot is None or self._stopping:
+                continue
+
+            print(f"{Fore.RED}[-] Worker {slot} exited with code {os.waitstatus_to_exitcode(status)}, "
+                  f"restarting it{Style.RESET_ALL}", file=sys.stderr, flush=True)
+            # Avoids a restart loop using all the CPU when workers fail at startup
+            time.sleep(1)
+            if not self._stopping:
+                self.spawn(slot, listener, vectorstores)
+
+        print(f"{Fore.GREEN}[+] All workers stopped{Style.RESET_ALL}", flush=True)
+
+    def stop(self, signum, frame) -> None:
+        """
+        Stops the workers, killing the ones still running after the shutdown timeout
+        """
+        if self._stopping:
+            return
+        self._stopping = True
+        print(f"{Fore.CYAN}[*] Stopping {len(self._children)} workers{Style.RESET_ALL}", flush=True)
+
+        for pid in list(self._children):
+            PreforkServer.signal_worker(pid, signal.SIGTERM)
+
+        def kill():
+            time.sleep(Config.worker_shutdown_timeout)
+            for pid in list(self._children):
+                PreforkServer.signal_worker(pid, signal.SIGKILL)
+
+        Thread(target=kill, name="shutdown", daemon=True).start()
+
+    @staticmethod
+    def signal_worker(pid: int, signum: int) -> None:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
@@ -14,9 +14,8 @@ public class ExportController(DatabaseService service) : ControllerBase
     [HttpGet("eval/xlsx/{id}")]
     public async Task<ActionResult> GetEvalExcelFile(string id)
     {
-        var collection = service.GetEvaluationCollection(id);
-        var list = await collection.GetAll();
-        if (list.Count == 0)
+        var data = await service.GetEvaluationData(id);
+        if (data == null)
         {
             return StatusCode(StatusCodes.Status404NotFound, new Response
             {
@@ -25,15 +24,14 @@ public class ExportController(DatabaseService service) : ControllerBase
             });  
         }
 
-        return File(ExcelSerializer.Serialize(list[0]), "application/xlsx", $"eval-{id}.xlsx");
+        return File(ExcelSerializer.Serialize(data), "application/xlsx", $"eval-{id}.xlsx");
     }
     
     [HttpGet("eval/json/{id}")]
     public async Task<ActionResult> GetEvalJsonFile(string id)
     {
-        var collection = service.GetEvaluationCollection(id);
-        var list = await collection.GetAll();
-        if (list.Count == 0)
+        var data = await service.GetEvaluationData(id);
+        if (data == null)
         {
             return StatusCode(StatusCodes.Status404NotFound, new Response
             {
@@ -42,14 +40,13 @@ public class ExportController(DatabaseService service) : ControllerBase
             });  
         }
 
-        return File(Encoding.UTF8.GetBytes(JsonSerializer.Serialize(list[0])), "application/json", $"eval-{id}.json");
+        return File(Encoding.UTF8.GetBytes(JsonSerializer.Serialize(data)), "application/json", $"eval-{id}.json");
     }
     
     [HttpGet("chat/xlsx/{id}")]
     public async Task<ActionResult> GetChatXlsxFile(string id)
     {
-        var collection = service.GetCollection<HistoryEntry>("history", id);
-        var list = await collection.GetAll();
+        var list = await service.GetHistory(id);
         if (list.Count == 0)
         {
             return StatusCode(StatusCodes.Status404NotFound, new Response
@@ -65,8 +62,7 @@ public class ExportController(DatabaseService service) : ControllerBase
     [HttpGet("chat/json/{id}")]
     public async Task<ActionResult> GetChatJsonFile(string id)
     {
-        var collection = service.GetCollection<HistoryEntry>("history", id);
-        var list = await collection.GetAll();
+        var list = await service.GetHistory(id);
         if (list.Count == 0)
         {
             return StatusCode(StatusCodes.Status404NotFound, new Response
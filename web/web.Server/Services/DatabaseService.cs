@@ -1,5 +1,6 @@
 using Microsoft.Extensions.Options;
 using MongoDB.Bson;
+using MongoDB.Bson.Serialization;
 using MongoDB.Driver;
 using web.Server.Models;
 
@@ -110,6 +111,11 @@ public class DatabaseService
     /// A reference to the database containing evaluation data
     /// </summary>
     private readonly IMongoDatabase _evaluationDatabase;
+
+    /// <summary>
+    /// A reference to the database containing the chat histories
+    /// </summary>
+    private readonly IMongoDatabase _historyDatabase;
     
     /// <summary>
     /// Initializes the database service using the provided options
@@ -119,6 +125,7 @@ public class DatabaseService
     {
         this._mongoClient = new MongoClient(options.Value.DatabaseUrl);
         this._evaluationDatabase = _mongoClient.GetDatabase("evaluation");
+        this._historyDatabase = _mongoClient.GetDatabase("history");
     }
     
     /// <summary>
@@ -134,13 +141,78 @@ public class DatabaseService
     }
 
     /// <summary>
-    /// Gets the evaluation data collection for the provided session
+    /// Retrieves the chat history of a session. Messages of all sessions are stored in the messages collection,
+    /// ordered by their sequence number in the session
+    /// </summary>
+    /// <param name="sessionId">The session to use</param>
+    /// <returns>The messages of the session, oldest first</returns>
+    public async Task<List<HistoryEntry>> GetHistory(string sessionId)
+    {
+        var messages = this._historyDatabase.GetCollection<BsonDocument>("messages");
+        var projection = Builders<BsonDocument>.Projection.Exclude("session_id").Exclude("seq");
+        
+        return await messages.Find(Builders<BsonDocument>.Filter.Eq("session_id", sessionId))
+            .Sort(Builders<BsonDocument>.Sort.Ascending("seq"))
+            .Project<HistoryEntry>(projection)
+            .ToListAsync();
+    }
+
+    /// <summary>
+    /// Retrieves the evaluation data of a session. The scenario and criteria are stored in the sessions collection,
+    /// the graded answers in the answers collection and their results in the evaluations collection
     /// </summary>
     /// <param name="sessionId">The session to use</param>
-    /// <returns>A CrudInstance to manipulate the session's evaluation data</returns>
-    public CrudInstance<EvaluationData> GetEvaluationCollection(string sessionId)
+    /// <returns>The evaluation data, or null if the session has no evaluation data</returns>
+    public async Task<EvaluationData?> GetEvaluationData(string sessionId)
     {
-        return new CrudInstance<EvaluationData>(this._evaluationDatabase, sessionId);
+        var session = await this._evaluationDatabase.GetCollection<BsonDocument>("sessions")
+            .Find(Builders<BsonDocument>.Filter.Eq("_id", sessionId))
+            .FirstOrDefaultAsync();
+
+        if (session == null)
+        {
+            return null;
+        }
+
+        var data = new EvaluationData
+        {
+            Scenario = session.GetValue("scenario", "").AsString,
+            Criteria = session.GetValue("criteria", new BsonArray()).AsBsonArray.Select(x => x.AsString).ToList()
+        };
+
+        var filter = Builders<BsonDocument>.Filter.Eq("session_id", sessionId);
+        var ascending = Builders<BsonDocument>.Sort.Ascending("_id");
+
+        // Answers are listed in the order they were first graded
+        var answers = await this._evaluationDatabase.GetCollection<BsonDocument>("answers")
+            .Find(filter).Sort(ascending).ToListAsync();
+
+        foreach (var answer in answers)
+        {
+            var key = answer["key"].AsString;
+            data.Answers[key] = answer["answer"].AsString;
+            data.Results[key] = [];
+        }
+
+        var projection = Builders<BsonDocument>.Projection.Exclude("_id").Exclude("session_id");
+        var results = await this._evaluationDatabase.GetCollection<BsonDocument>("evaluations")
+            .Find(filter).Sort(ascending).Project(projection).ToListAsync();
+
+        foreach (var result in results)
+        {
+            var key = result["answer_key"].AsString;
+            result.Remove("answer_key");
+
+            if (!data.Results.TryGetValue(key, out var list))
+            {
+                list = [];
+                data.Results[key] = list;
+            }
+            
+            list.Add(BsonSerializer.Deserialize<EvaluationResult>(result));
+        }
+
+        return data;
     }
 
 }
\ No newline at end of file